@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Runs splitter and mkgmap for one map. Used for local builds and by
+# workers of a distributed build (see libDistributed.py), which is why
+# a BuildJob only contains plain values.
+
+from libRegion import Region, readAreas
+import libProgress
+import os
+import glob
+import time
+
+mkgmapOptions = '--route  --remove-short-arcs --add-pois-to-areas --index --adjust-turn-headings --check-roundabouts --merge-lines --keep-going --remove-short-arcs --latin1 --route --make-opposite-cycleways --add-pois-to-areas --preserve-element-order --location-autofill=1'
+
+class BuildJob :
+    """What to build: The osm file, the map ID of the first tile, and the
+    arguments for splitter and mkgmap. bbox and polygon restrict the
+    compiled tiles to a region (see libRegion.py)."""
+
+    fields = ['name', 'mapid', 'osmfile', 'splitterArgs', 'mkgmapArgs', 'bbox', 'polygon']
+
+    def __init__(self, name='', mapid='', osmfile='', splitterArgs='', mkgmapArgs='', bbox=None, polygon=None) :
+        self.name = name
+        self.mapid = mapid
+        self.osmfile = osmfile
+        self.splitterArgs = splitterArgs
+        self.mkgmapArgs = mkgmapArgs
+        self.bbox = bbox
+        self.polygon = polygon
+
+    def toDict(self) :
+        return dict([(f, getattr(self, f)) for f in BuildJob.fields])
+
+    @staticmethod
+    def fromDict(d) :
+        job = BuildJob()
+        for f in BuildJob.fields :
+            setattr(job, f, d.get(f))
+        return job
+
+    def region(self) :
+        region = Region()
+        if self.bbox is not None : region.addBBox(self.bbox)
+        if self.polygon is not None : region.addPolygon(self.polygon)
+        return region
+
+
+def runBuild(job, wdir, logfile, splitter, mkgmap, ram, tmpdir=None, phase=None, prefix='') :
+    """Splits the osm file into wdir and compiles the tiles there.
+    phase(phase, **args) is called when splitter or mkgmap starts
+    (see libProgress.Progress.phase). Returns a dictionary with ok (True
+    on success), tiles (number of compiled tiles), splitter-seconds
+    and mkgmap-seconds."""
+
+    result = {'ok' : False, 'tiles' : 0, 'splitter-seconds' : None, 'mkgmap-seconds' : None}
+
+    cmd = 'cd %s && java -Xmx%s -jar %s --mapid=%s --status-freq=1 %s %s 1>%s' % (wdir, ram, splitter, job.mapid, job.splitterArgs, job.osmfile, logfile)
+    print('%sSplitter: %s' % (prefix, cmd))
+    if phase is not None : phase(libProgress.PHASE_SPLITTER, logfile=logfile)
+    t0 = time.time()
+    if os.system(cmd) != 0 :
+        print('%sError running splitter! Cannot build map %s.' % (prefix, job.osmfile))
+        return result
+    result['splitter-seconds'] = time.time() - t0
+
+    filelist = glob.glob(os.path.join(wdir, '*.osm.pbf'))
+    print('%sSplit map files are %s' % (prefix, filelist))
+    region = job.region()
+    if not region.empty() :
+        # Only compile the tiles intersecting the region
+        try :
+            areas = readAreas(os.path.join(wdir, 'areas.list'))
+            filelist = [f for f in filelist if os.path.basename(f)[:8] not in areas or region.intersects(*areas[os.path.basename(f)[:8]])]
+            print('%sSplit map files in %s: %s' % (prefix, region.description(), filelist))
+        except IOError :
+            print('%sNo areas.list written by splitter, building all tiles.' % (prefix))
+    if len(filelist) == 0 :
+        print('%sNo tiles in %s.' % (prefix, region.description()))
+        result['ok'] = True
+        return result
+
+    # Create a .img file for this map
+    jargs = ''
+    if tmpdir is not None : jargs += ' -Djava.io.tmpdir=%s' % (tmpdir)
+    cmd = 'cd %s && java%s -enableassertions -Xmx%s -jar %s %s %s -n %s %s' % (wdir, jargs, ram, mkgmap, mkgmapOptions, job.mkgmapArgs, job.mapid, ' '.join(filelist))
+    print('%smkgmap: %s' % (prefix, cmd))
+    if phase is not None : phase(libProgress.PHASE_MKGMAP, workdir=wdir, tiles=len(filelist))
+    t0 = time.time()
+    if os.system(cmd) != 0 :
+        print('%sError building map %s!' % (prefix, job.osmfile))
+        return result
+    result['mkgmap-seconds'] = time.time() - t0
+    result['tiles'] = len(filelist)
+    result['ok'] = True
+    return result
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Keeps the data directory (split files and tiles of each map) within a
+# disk budget. Least recently used maps are evicted first, and cheap
+# files before expensive ones: split files and logs can be re-generated
+# by splitter, renumbered tile copies by copying the cached tiles again,
+# the cached tiles only by running mkgmap.
+
+from libSettingsfile import SettingsFile
+from libMapinfo import MapInfo
+import os
+import re
+
+reImgname = re.compile('(\d{4})\d{4}\.img$')
+reMerged = re.compile('^(?P<name>.+\+.+)\.osm\.pbf$')	# Merged maps, see libMerge.py
+
+# Eviction order (cheapest to re-generate first)
+TIER_SPLITS = 0
+TIER_COPIES = 1
+TIER_TILES = 2
+tierNames = ['split files', 'tile copies', 'tiles']
+
+
+class CacheEntry :
+    """Files of one map in one tier, which are evicted together."""
+
+    def __init__(self, name, tier, files, lastUsed) :
+        self.name = name
+        self.tier = tier
+        self.files = files
+        self.lastUsed = lastUsed
+        self.size = 0
+        for f in files :
+            try :
+                self.size += os.path.getsize(f)
+            except OSError :
+                None
+
+
+def cacheEntries(dirData, dirXml) :
+    """All cache entries in the data directory."""
+
+    entries = []
+    # Merged maps can be merged again and count as split files of their map
+    merged = {}
+    for f in os.listdir(dirData) :
+        o = reMerged.match(f)
+        if o is not None and os.path.isfile(os.path.join(dirData, f)) :
+            merged[o.group('name')] = os.path.join(dirData, f)
+    names = [n for n in os.listdir(dirData) if os.path.isdir(os.path.join(dirData, n))]
+    for name in sorted(set(names) | set(merged)) :
+        sdir = os.path.join(dirData, name)
+
+        lastUsed = 0
+        tilePrefix = ''
+        xml = os.path.join(dirXml, name + '.xml')
+        if os.path.exists(xml) :
+            info = SettingsFile(xml)
+            try :
+                lastUsed = float(info.text(MapInfo.I_LAST_USED, '0'))
+            except ValueError :
+                None
+            tilePrefix = info.text(MapInfo.I_TILE_PREFIX)
+        if lastUsed == 0 :
+            lastUsed = os.path.getmtime(sdir if name in names else merged[name])
+
+        files = [[], [], []]
+        if name in merged :
+            files[TIER_SPLITS].append(merged[name])
+        for f in (os.listdir(sdir) if name in names else []) :
+            path = os.path.join(sdir, f)
+            if not os.path.isfile(path) :
+                continue
+            o = reImgname.search(f)
+            if o is None :
+                files[TIER_SPLITS].append(path)
+            elif tilePrefix != '' and o.group(1) != tilePrefix :
+                files[TIER_COPIES].append(path)
+            else :
+                files[TIER_TILES].append(path)
+        for tier in range(len(files)) :
+            if len(files[tier]) > 0 :
+                entries.append(CacheEntry(name, tier, files[tier], lastUsed))
+    return entries
+
+
+def collectGarbage(dirData, dirXml, budget, keep=[]) :
+    """Evicts cache entries until the data directory fits into budget
+    (in bytes). Maps named in keep are not touched. Entries are evicted
+    by tier, and least recently used first within a tier.
+    Returns (total size before, freed bytes, evicted entries)."""
+
+    entries = cacheEntries(dirData, dirXml)
+    total = sum([e.size for e in entries])
+    freed = 0
+    evicted = []
+
+    candidates = [e for e in entries if e.name not in keep]
+    candidates.sort(key=lambda e : (e.tier, e.lastUsed))
+    for e in candidates :
+        if total - freed <= budget :
+            break
+        for f in e.files :
+            try :
+                os.remove(f)
+            except OSError :
+                print('Could not remove %s.' % (f))
+        freed += e.size
+        evicted.append(e)
+    return (total, freed, evicted)
+
+
+def printGarbage(total, freed, evicted) :
+    for e in evicted :
+        print('Evicted %s of %s: %d files, %.1f MB' % (tierNames[e.tier], e.name, len(e.files), e.size / 1048576.0))
+    print('Cache: %.1f MB, freed %.1f MB, now %.1f MB.' % (total / 1048576.0, freed / 1048576.0, (total - freed) / 1048576.0))
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Distributed builds. The coordinator does the planning as usual (which
+# maps need to be rebuilt, re-use of tiles, gmapsupp) and sends each
+# splitter/mkgmap job to a worker. Workers run the job with their own
+# splitter, mkgmap and RAM settings and put the tiles into a tile store
+# shared with the coordinator, e.g. on a network file system.
+# Input files, style file and geonames file need to be reachable under
+# the same path for all workers.
+#
+# Protocol: One JSON object per line over TCP.
+#   worker -> coordinator  {"type": "hello", "worker": name}
+#   coordinator -> worker  {"type": "job", "id": n, "job": {...}}
+#   worker -> coordinator  {"type": "accepted", "id": n}
+#   worker -> coordinator  {"type": "alive"} (while working)
+#   worker -> coordinator  {"type": "result", "id": n, "result": {...}}
+# A job whose worker disconnects or stops sending is given to another
+# worker. Results are checked before the coordinator touches any file,
+# as there is no authentication; the coordinator only listens on
+# localhost unless another address is given.
+
+from __future__ import with_statement
+from libGarminImg import copyFile, fileDigest
+from libBuild import BuildJob, runBuild
+import os
+import re
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import Queue
+try :
+    import fcntl
+except ImportError :
+    fcntl = None
+
+reTile = re.compile('^\d{8}\.img$')
+reDigest = re.compile('^[0-9a-f]{32}$')
+
+heartbeat = 10		# Seconds between alive messages of a busy worker
+timeout = 6*heartbeat	# A worker not sending anything for this long is considered lost
+maxAttempts = 3		# Workers a job is given to before it fails
+
+
+class TileStore :
+    """Content addressed storage for tiles: <dir>/ab/abcdef....img"""
+
+    def __init__(self, dir) :
+        self.dir = os.path.abspath(dir)
+        if not os.path.exists(self.dir) :
+            os.makedirs(self.dir)
+
+    def path(self, digest) :
+        if reDigest.match(str(digest)) is None :
+            raise ValueError('Invalid tile digest %r' % (digest))
+        return os.path.join(self.dir, digest[:2], digest + '.img')
+
+    def put(self, filename) :
+        """Adds the file to the store, returns its digest."""
+        digest = fileDigest(filename)
+        path = self.path(digest)
+        if not os.path.exists(path) :
+            if not os.path.exists(os.path.dirname(path)) :
+                try :
+                    os.makedirs(os.path.dirname(path))
+                except OSError :
+                    # Created by another worker in the meantime
+                    None
+            (fd, tmp) = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+            os.close(fd)
+            shutil.copyfile(filename, tmp)
+            # mkstemp creates the file readable for the owner only, the
+            # store may be shared by users on several machines
+            shutil.copymode(filename, tmp)
+            os.rename(tmp, path)
+        return digest
+
+    def get(self, digest, filename) :
+        """Copies the tile with the given digest to filename."""
+        path = self.path(digest)
+        (fd, tmp) = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+        os.close(fd)
+        try :
+            copyFile(path, tmp)
+            shutil.copymode(path, tmp)
+            os.rename(tmp, filename)
+        except :
+            os.remove(tmp)
+            raise
+
+
+class Connection :
+    """JSON lines over a socket."""
+
+    def __init__(self, sock) :
+        self.sock = sock
+        self.file = sock.makefile('r')
+        self.lock = threading.Lock()
+
+    def send(self, msg) :
+        with self.lock :
+            self.sock.sendall(json.dumps(msg) + '\n')
+
+    def receive(self) :
+        """Next message, or None if the connection has been closed."""
+        line = self.file.readline()
+        if not line :
+            return None
+        return json.loads(line)
+
+    def close(self) :
+        try :
+            self.sock.close()
+        except socket.error :
+            None
+
+
+def checkResult(result) :
+    """The result of a worker if it is well-formed, otherwise a failed
+    result. Tile names must be \\d{8}.img and digests MD5 hex digests."""
+    if not isinstance(result, dict) or result.get('ok') not in (True, False) :
+        print('Invalid result from worker: %r' % (result))
+        return {'ok' : False}
+    if result['ok'] :
+        tiles = result.get('tiles-stored')
+        if not isinstance(tiles, dict) :
+            print('Invalid result from worker, no tiles: %r' % (result))
+            return {'ok' : False}
+        for (name, digest) in tiles.items() :
+            if reTile.match(name) is None or not isinstance(digest, basestring) or reDigest.match(digest) is None :
+                print('Invalid tile from worker: %r: %r' % (name, digest))
+                return {'ok' : False}
+    return result
+
+
+class PendingJob :
+    def __init__(self, job) :
+        self.job = job
+        self.result = None
+        self.attempts = 0
+        self.done = threading.Event()
+
+
+class Coordinator :
+
+    def __init__(self, port, host='127.0.0.1') :
+        self.queue = Queue.Queue()
+        self.count = 0
+        self.lock = threading.Lock()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]	# If port was 0
+        t = threading.Thread(target=self.accept)
+        t.setDaemon(True)
+        t.start()
+        print('Coordinator waiting for workers on %s:%d.' % (host, self.port))
+
+    def accept(self) :
+        while True :
+            (sock, address) = self.server.accept()
+            t = threading.Thread(target=self.serve, args=(sock, address))
+            t.setDaemon(True)
+            t.start()
+
+    def run(self, job) :
+        """Lets a worker build the job (a BuildJob) and waits for it.
+        Returns the result of runBuild() plus tile names and digests
+        (tiles-stored), or a failed result if no worker succeeded."""
+        pending = PendingJob(job)
+        self.queue.put(pending)
+        pending.done.wait()
+        return pending.result
+
+    def serve(self, sock, address) :
+        """Handles one worker connection until the worker is lost."""
+        conn = Connection(sock)
+        sock.settimeout(timeout)
+        pending = None
+        try :
+            msg = conn.receive()
+            if msg is None or msg.get('type') != 'hello' :
+                conn.close()
+                return
+            name = '%s (%s)' % (msg.get('worker'), address[0])
+            print('Worker %s connected.' % (name))
+            while True :
+                pending = self.queue.get()
+                with self.lock :
+                    self.count += 1
+                    id = self.count
+                print('Sending %s to worker %s.' % (pending.job.name, name))
+                conn.send({'type' : 'job', 'id' : id, 'job' : pending.job.toDict()})
+                while True :
+                    msg = conn.receive()
+                    if msg is None :
+                        raise socket.error('Connection closed')
+                    if msg.get('type') == 'accepted' and msg.get('id') == id :
+                        # Only attempts of live workers count
+                        pending.attempts += 1
+                    if msg.get('type') == 'result' and msg.get('id') == id :
+                        break
+                pending.result = checkResult(msg.get('result'))
+                pending.done.set()
+                pending = None
+        except (socket.error, socket.timeout, ValueError, AttributeError) as e :
+            # AttributeError: A message which is not a JSON object
+            print('Lost worker %s: %s' % (address[0], e))
+            conn.close()
+            if pending is not None :
+                if pending.attempts < maxAttempts :
+                    # Also if the worker was lost before accepting the job
+                    print('Re-queueing %s.' % (pending.job.name))
+                    self.queue.put(pending)
+                else :
+                    print('Giving up %s after %d attempts.' % (pending.job.name, pending.attempts))
+                    pending.result = {'ok' : False}
+                    pending.done.set()
+
+
+class Worker :
+
+    def __init__(self, address, store, splitter, mkgmap, ram, scratch=None) :
+        (host, port) = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.store = store
+        self.splitter = splitter
+        self.mkgmap = mkgmap
+        self.ram = ram
+        self.scratch = scratch
+        self.name = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.sock = None
+
+    def run(self) :
+        """Builds jobs until the coordinator closes the connection."""
+        sock = socket.create_connection(self.address)
+        self.sock = sock
+        if fcntl is not None :
+            # Otherwise splitter and mkgmap keep the connection open if the worker dies
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.fcntl(sock.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        conn = Connection(sock)
+        conn.send({'type' : 'hello', 'worker' : self.name})
+        print('Worker %s connected to %s:%d.' % (self.name, self.address[0], self.address[1]))
+        while True :
+            msg = conn.receive()
+            if msg is None :
+                break
+            if msg.get('type') != 'job' :
+                continue
+            conn.send({'type' : 'accepted', 'id' : msg['id']})
+            result = self.build(BuildJob.fromDict(msg['job']), conn)
+            conn.send({'type' : 'result', 'id' : msg['id'], 'result' : result})
+        conn.close()
+        print('Coordinator closed the connection.')
+
+    def build(self, job, conn) :
+        """Runs the job in a temporary directory and stores the tiles."""
+        busy = threading.Event()
+        def alive() :
+            while not busy.wait(heartbeat) :
+                try :
+                    conn.send({'type' : 'alive'})
+                except socket.error :
+                    return
+        t = threading.Thread(target=alive)
+        t.setDaemon(True)
+        t.start()
+
+        wdir = tempfile.mkdtemp(prefix='%s-' % (job.name), dir=self.scratch)
+        try :
+            result = runBuild(job, wdir, os.path.join(wdir, 'log-mkgmap.txt'), self.splitter, self.mkgmap, self.ram, tmpdir=wdir, prefix='%s \t' % (job.name))
+            result['tiles-stored'] = {}
+            if result['ok'] :
+                for f in os.listdir(wdir) :
+                    if reTile.match(f) :
+                        result['tiles-stored'][f] = self.store.put(os.path.join(wdir, f))
+        finally :
+            busy.set()
+            shutil.rmtree(wdir, True)
+        return result
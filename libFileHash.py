@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Content digests of the input files (.osm.bz2/.osm.pbf), for detecting
+# changed maps. Files are read in large blocks, several files and
+# segments of large files at once, and hashed with CRC-32 which is far
+# cheaper than MD5. Digests are stored with path, size, modification
+# time and inode of the file, so unchanged files are not read again.
+
+from __future__ import with_statement
+from lxml import etree
+from libSettingsfile import SettingsFile
+from libGarminImg import mtimeNs
+import os
+import time
+import zlib
+import hashlib
+import threading
+import Queue
+
+blockSize = 1<<24	# Bytes read at once
+segmentSize = 1<<28	# Files are hashed in segments of this size in parallel
+
+def hashSegment(filename, offset, length) :
+    """CRC-32 of length bytes of the file starting at offset."""
+    crc = 0
+    with open(filename, 'rb') as f :
+        f.seek(offset)
+        while length > 0 :
+            s = f.read(min(blockSize, length))
+            if not s : break
+            crc = zlib.crc32(s, crc)
+            length -= len(s)
+    return crc & 0xffffffff
+
+def combine(size, crcs) :
+    """Digest of a file from the CRCs of its segments."""
+    return hashlib.md5('%d %s' % (size, ' '.join(['%08x' % (c) for c in crcs]))).hexdigest()
+
+
+class DigestCache(SettingsFile) :
+
+    T_FILE = 'file'
+
+    def __init__(self, filename) :
+        SettingsFile.__init__(self, filename, rootTag=etree.Element('pyMkgmap', src="openstreetmap.org", obj="digests"), writeback=False, forceTag=True)
+        self.lock = threading.Lock()
+        self.entries = {}
+        for node in self.doc.findall(DigestCache.T_FILE) :
+            try :
+                key = (node.get('path'), int(node.get('size')), int(node.get('mtime-ns')), int(node.get('inode')))
+                self.entries[key[0]] = (key, node)
+            except (TypeError, ValueError) :
+                self.doc.remove(node)
+
+    def digests(self, filenames, threads=1) :
+        """Digests of the given files as a dictionary path -> digest
+        (absolute paths). Files which are unchanged since they have been
+        hashed are not read. Files which cannot be read are missing."""
+
+        result = {}
+        todo = []
+        for filename in set([os.path.abspath(f) for f in filenames]) :
+            try :
+                st = os.stat(filename)
+            except OSError :
+                print('Cannot hash %s, file not found.' % (filename))
+                continue
+            key = (filename, st.st_size, mtimeNs(st), st.st_ino)
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] == key :
+                result[filename] = entry[1].get('digest')
+            else :
+                todo.append(key)
+        cached = len(result)
+
+        # One task per segment
+        queue = Queue.Queue()
+        crcs = {}
+        for key in todo :
+            segments = range(0, max(1, key[1]), segmentSize)
+            crcs[key] = [None] * len(segments)
+            for i in range(len(segments)) :
+                queue.put((key, i, segments[i]))
+        failed = set()
+
+        def work() :
+            while True :
+                try :
+                    (key, i, offset) = queue.get_nowait()
+                except Queue.Empty :
+                    return
+                try :
+                    crc = hashSegment(key[0], offset, segmentSize)
+                except IOError as e :
+                    print('Cannot hash %s: %s' % (key[0], e))
+                    with self.lock :
+                        failed.add(key)
+                    continue
+                with self.lock :
+                    crcs[key][i] = crc
+
+        t0 = time.time()
+        workers = [threading.Thread(target=work) for i in range(max(1, min(threads, queue.qsize())))]
+        for w in workers :
+            w.start()
+        for w in workers :
+            w.join()
+        seconds = time.time() - t0
+
+        for key in todo :
+            if key in failed :
+                continue
+            result[key[0]] = combine(key[1], crcs[key])
+            self.set(key, result[key[0]])
+        if len(todo) > 0 :
+            self.write()
+            size = sum([key[1] for key in todo if key not in failed]) / 1048576.0
+            print('Hashed %d input files (%.0f MB) in %.1f s, %.0f MB/s; %d unchanged files not read.' % (len(todo) - len(failed), size, seconds, size / max(seconds, 0.001), cached))
+        elif cached > 0 :
+            print('%d input files unchanged, not hashed.' % (cached))
+        return result
+
+    def set(self, key, digest) :
+        entry = self.entries.pop(key[0], None)
+        if entry is not None :
+            self.doc.remove(entry[1])
+        node = etree.SubElement(self.doc, DigestCache.T_FILE, path=key[0], size=str(key[1]), inode=str(key[3]), digest=digest)
+        node.set('mtime-ns', str(key[2]))
+        self.entries[key[0]] = (key, node)
@@ -12,6 +12,16 @@
 from __future__ import with_statement # Python rocks ;)
 import os # Path manipulation
 import mmap # Binary Editing
+import struct # Reading binary values
+import hashlib # Content digests
+import threading # Parallel verification
+import Queue
+import shutil
+import tempfile
+try :
+    import fcntl # Reflinks (Linux only)
+except ImportError :
+    fcntl = None
 
 
 
@@ -28,6 +38,64 @@ def bin2hex(b) :
     """Binary input: '\64\65', string output: '6465'"""
     return b.encode('hex')
 
+def int24(b) :
+    """Signed little endian 24 bit integer: '\xff\xff\xff' -> -1"""
+    n = struct.unpack('<I', b + ('\xff' if ord(b[2]) & 0x80 else '\x00'))[0]
+    if n & 0x80000000 :
+        n -= 0x100000000
+    return n
+
+def units2deg(u) :
+    """Garmin map units (24 bit for 360 degrees) to degrees."""
+    return u * 360.0 / (1 << 24)
+
+def mtimeNs(st) :
+    """Modification time in nanoseconds of a stat result."""
+    try :
+        return st.st_mtime_ns
+    except AttributeError :
+        return int(round(st.st_mtime * 1000000000))
+
+def fileDigest(filename, blocksize=1<<20) :
+    """MD5 hex digest of the file's content."""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f :
+        while True :
+            s = f.read(blocksize)
+            if not s : break
+            md5.update(s)
+    return md5.hexdigest()
+
+# ioctl request for cloning a whole file on CoW file systems (btrfs, XFS)
+FICLONE = 0x40049409
+
+def copyFile(src, dst) :
+    """Copies src to dst. Uses a reflink if the file system supports it,
+    so the copy does not take any additional space until modified, 
+    otherwise a plain copy. Returns the method used."""
+    
+    with open(src, 'rb') as fs :
+        with open(dst, 'wb') as fd :
+            if fcntl is not None :
+                try :
+                    fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+                    return 'reflink'
+                except (IOError, OSError) :
+                    None
+            shutil.copyfileobj(fs, fd, 1<<20)
+    return 'copy'
+
+
+
+
+class Subfile :
+    """Entry of the File Allocation Table: e.g. 63240001 TRE at offset 0x1000."""
+    def __init__(self, name, type, offset, size) :
+        self.name = name
+        self.type = type
+        self.offset = offset
+        self.size = size
+
 
 
 
@@ -40,18 +108,175 @@ class GarminImg :
     def __init__(self, filename) :
         self.filename = os.path.abspath(filename)
     
+    # Offsets in the img header.
+    offsetSignature = 0x10
+    offsetIdentifier = 0x41
+    offsetBlockSizeE1 = 0x61
+    offsetBlockSizeE2 = 0x62
+    # Starting position and entry size of the File Allocation Table.
+    offsetFAT = 0x600
+    sizeFATEntry = 0x200
+    
     # Offsets relative to the beginning of the TRE section.
+    offsetBounds = 0x15
     offsetMapID = 0x74 
     offsetMapValues = 0x9a
     
+    def readInfo(self) :
+        """Read the FAT and the TRE header without modifying the file.
+        Sets subfiles, mapId, headerLength, bounds (north, east, south, 
+        west in map units) and digest. Returns False if the file could 
+        not be parsed."""
+        
+        self.subfiles = []
+        self.mapId = None
+        self.headerLength = None
+        self.bounds = None
+        self.digest = None
+        
+        try :
+            with open(self.filename, 'rb') as f :
+                map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try :
+                    self.subfiles = self.readFAT(map)
+                    pos = self.trePosition(map)
+                    if pos < 0 or pos + GarminImg.offsetMapValues > len(map) :
+                        return False
+                    self.headerLength = struct.unpack('<H', map[pos : pos+2])[0]
+                    l = pos+GarminImg.offsetMapID
+                    self.mapId = struct.unpack('<I', map[l : l+4])[0]
+                    l = pos+GarminImg.offsetBounds
+                    self.bounds = tuple([int24(map[l+3*i : l+3*(i+1)]) for i in range(4)])
+                finally :
+                    map.close()
+            self.digest = fileDigest(self.filename)
+        except (IOError, ValueError, struct.error) :
+            # ValueError: mmap of an empty file
+            return False
+        return True
+    
+    def verify(self) :
+        """Quick integrity check of a tile, e.g. after a crashed mkgmap run
+        or a full disk. Only the headers are read. Checks the img header,
+        the FAT block lists, subfile bounds against the file 
+        size, and whether the TRE map ID and its MapValues agree.
+        Returns a list of problems, empty if the tile looks fine."""
+        
+        problems = []
+        try :
+            with open(self.filename, 'rb') as f :
+                map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try :
+                    problems = self.verifyMap(map)
+                finally :
+                    map.close()
+        except (IOError, ValueError) as e :
+            problems.append('Cannot read file: %s' % (e))
+        return problems
+    
+    def verifyMap(self, map) :
+        size = len(map)
+        if size < GarminImg.offsetFAT + GarminImg.sizeFATEntry :
+            return ['File too short (%d bytes)' % (size)]
+        if map[GarminImg.offsetSignature : GarminImg.offsetSignature+7] != 'DSKIMG\x00' \
+                or map[GarminImg.offsetIdentifier : GarminImg.offsetIdentifier+7] != 'GARMIN\x00' :
+            return ['No img header']
+        
+        problems = []
+        bs = self.blockSize(map)
+        
+        # Walk the FAT. Further entries of the same subfile have an 
+        # increasing part number. A block list ends with 0xffff or with 
+        # the end of the entry.
+        pos = GarminImg.offsetFAT
+        subfiles = []	# [name, size, blocks]
+        while pos >= size or not (map[pos] == '\x00') :
+            if pos + GarminImg.sizeFATEntry > size :
+                return problems + ['FAT not terminated']
+            name = map[pos+1 : pos+12]
+            part = struct.unpack('<H', map[pos+16 : pos+18])[0]
+            if part == 0 or len(subfiles) == 0 or subfiles[-1][0] != name :
+                subfiles.append([name, struct.unpack('<I', map[pos+12 : pos+16])[0], []])
+            for b in struct.unpack('<240H', map[pos+32 : pos+GarminImg.sizeFATEntry]) :
+                if b == 0xffff : break
+                subfiles[-1][2].append(b)
+            pos += GarminImg.sizeFATEntry
+        if len(subfiles) == 0 :
+            return ['Empty FAT']
+        for (name, sfsize, blocks) in subfiles :
+            if len(blocks) < (sfsize + bs - 1) // bs :
+                problems.append('Block list of %s too short (%d blocks for %d bytes)' % (name, len(blocks), sfsize))
+            for b in blocks :
+                if b * bs >= size :
+                    problems.append('Block %d of %s beyond end of file' % (b, name))
+                    break
+        
+        self.subfiles = self.readFAT(map)
+        for sf in self.subfiles :
+            if sf.offset + sf.size > size :
+                problems.append('Subfile %s%s (0x%x + %d bytes) exceeds file size %d' % (sf.name, sf.type, sf.offset, sf.size, size))
+        
+        # Map ID and its checksum values in the TRE header
+        pos = self.trePosition(map)
+        if pos < 0 or pos + GarminImg.offsetMapValues + 16 > size :
+            return problems + ['No TRE header']
+        if map[pos+2 : pos+12] != 'GARMIN TRE' :
+            return problems + ['Invalid TRE header at 0x%x' % (pos)]
+        headerLength = struct.unpack('<H', map[pos : pos+2])[0]
+        l = pos+GarminImg.offsetMapID
+        mapId = struct.unpack('<I', map[l : l+4])[0]
+        l = pos+GarminImg.offsetMapValues
+        values = struct.unpack('<4I', map[l : l+16])
+        if values != MapValues.batch([mapId], headerLength)[0] :
+            problems.append('MapValues do not match map ID %d' % (mapId))
+        names = set([sf.name for sf in self.subfiles])
+        if names != set(['%08d' % (mapId)]) :
+            problems.append('Subfile names %s do not match map ID %d' % (', '.join(sorted(names)), mapId))
+        
+        return problems
+    
+    def blockSize(self, map) :
+        """Block size of the image, given by two exponents in the header."""
+        return 1 << (ord(map[GarminImg.offsetBlockSizeE1]) + ord(map[GarminImg.offsetBlockSizeE2]))
+    
+    def readFAT(self, map) :
+        """List of Subfiles. Entries continuing a subfile (part number > 0)
+        only contain further blocks and are skipped."""
+        
+        subfiles = []
+        bs = self.blockSize(map)
+        pos = GarminImg.offsetFAT
+        while pos + GarminImg.sizeFATEntry <= len(map) and not (map[pos] == '\x00') :
+            part = struct.unpack('<H', map[pos+16 : pos+18])[0]
+            if part == 0 :
+                size = struct.unpack('<I', map[pos+12 : pos+16])[0]
+                block = struct.unpack('<H', map[pos+32 : pos+34])[0]
+                subfiles.append(Subfile(map[pos+1 : pos+9], map[pos+9 : pos+12], block*bs, size))
+            pos += GarminImg.sizeFATEntry
+        return subfiles
+    
+    def trePosition(self, map) :
+        """Position of the TRE subfile. Taken from the FAT if possible, 
+        otherwise by searching for its header."""
+        
+        for sf in self.subfiles :
+            if sf.type == 'TRE' :
+                return sf.offset
+        pos = map.find('GARMIN TRE')
+        if pos < 0 :
+            return pos
+        return pos & 0xffffffffffffff00
+    
     def binWord(self, id) :
         """Return the little endian byte representation of the 32bit input string"""
         return ('%08x' % (int(id))).decode('hex')[::-1]
 
-    def updateID(self, toID, prefix='') :
+    def updateID(self, toID, prefix='', values=None) :
         """Changes the map ID. The ID is saved in binary format as well 
         as a hash which needs to be correct, otherwise the map will not 
-        be displayed on the Garmin device (most likely)."""
+        be displayed on the Garmin device (most likely).
+        values: The four hash values if already known (see MapValues.batch),
+        they are calculated otherwise."""
         
         with open(self.filename, 'r+b') as f :
             map = mmap.mmap(f.fileno(), 0) # 0: Read whole file
@@ -77,19 +302,48 @@ class GarminImg :
             
             # Find current ID hash and print it (also just for fun)
             l = pos+GarminImg.offsetMapValues
-            values = [map[l+4*i : l+4*(i+1)][::-1] for i in range(4)]
-            print('%sValues: %s %s %s %s (original)' % (prefix, bin2hex(values[0]), bin2hex(values[1]), bin2hex(values[2]), bin2hex(values[3])))
+            old = [map[l+4*i : l+4*(i+1)][::-1] for i in range(4)]
+            print('%sValues: %s %s %s %s (original)' % (prefix, bin2hex(old[0]), bin2hex(old[1]), bin2hex(old[2]), bin2hex(old[3])))
             
             # Calculate new ID hash and write it to the img file.
-            mv = MapValues(toID, headerLength)
-            mv.calculate()
-            print('%sValues: %08x %08x %08x %08x (calculated)' % (prefix, mv.value(0), mv.value(1), mv.value(2), mv.value(3)))
+            if values is None :
+                values = MapValues.batch([toID], headerLength)[0]
+            print('%sValues: %08x %08x %08x %08x (calculated)' % (prefix, values[0], values[1], values[2], values[3]))
             for i in range(4) : 
-                map[l+4*i : l+4*(i+1)] = self.binWord(mv.value(i))
+                map[l+4*i : l+4*(i+1)] = self.binWord(values[i])
             
 
 
-    def rename(self, toID, prefix='') :
+    def copyWithID(self, toID, filename, prefix='', values=None) :
+        """Writes a copy of this image with the map ID toID to filename; 
+        the original file is not modified. The bulk of the file is copied 
+        with copyFile(), only the FAT names and the TRE header are patched 
+        (see rename()). The copy is moved into place atomically, an
+        interrupted copy therefore leaves no damaged tile behind.
+        Returns the GarminImg of the copy, or None on failure."""
+        
+        filename = os.path.abspath(filename)
+        (fd, tmp) = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(filename))
+        os.close(fd)
+        try :
+            method = copyFile(self.filename, tmp)
+            gi = GarminImg(tmp)
+            t = gi.rename(toID, prefix, values)
+            if t is None :
+                os.remove(tmp)
+                return None
+            # mkstemp creates the file readable for the owner only
+            shutil.copymode(self.filename, tmp)
+            os.rename(tmp, filename)
+            print('%sCopied %s to %s (%s), replaced old map ID (%s) %s times.' % (prefix, self.filename, filename, method, t[2], t[0]))
+        except (IOError, OSError) as e :
+            print('%sCould not copy %s to %s: %s' % (prefix, self.filename, filename, e))
+            if os.path.exists(tmp) :
+                os.remove(tmp)
+            return None
+        return GarminImg(filename)
+
+    def rename(self, toID, prefix='', values=None) :
         """Renames the file names of all subfiles in the File Allocation Table (FAT) section.
         Example: 00010230RGN, 00010230TRE, 00010230LBL (8 digit name, file type)"""
         try :
@@ -118,7 +372,7 @@ class GarminImg :
                         pos += 0x200
                 
                 # Change the map ID too.
-                self.updateID(toID, prefix)
+                self.updateID(toID, prefix, values)
                 
                 return (count, renamed, oldid)
             else :
@@ -127,6 +381,41 @@ class GarminImg :
             print('%sWrong ID: %s (needs to be 8 digits)' % (prefix, toID))
         return None
 
+def verifyImgs(filenames, threads=1) :
+    """Verifies the given tiles in parallel (see GarminImg.verify()).
+    Returns a dictionary filename -> problems containing the suspect tiles."""
+    
+    queue = Queue.Queue()
+    suspect = {}
+    lock = threading.Lock()
+    for filename in filenames :
+        queue.put(filename)
+    
+    def work() :
+        while True :
+            try :
+                filename = queue.get_nowait()
+            except Queue.Empty :
+                return
+            try :
+                problems = GarminImg(filename).verify()
+            except Exception as e :
+                # Keep the thread alive for the remaining files
+                problems = ['Verification failed: %r' % (e)]
+            if len(problems) > 0 :
+                with lock :
+                    suspect[filename] = problems
+    
+    workers = [threading.Thread(target=work) for i in range(max(1, min(threads, len(filenames))))]
+    for w in workers :
+        w.start()
+    for w in workers :
+        w.join()
+    return suspect
+
+
+
+
 class MapValues :
     # This is the Python copy of this file:
     # http://svn.parabola.me.uk/mkgmap/trunk/src/uk/me/parabola/imgfmt/app/trergn/MapValues.java
@@ -136,6 +425,7 @@ class MapValues :
         self.length = headerLength
         
         self.values = [range(8), range(8), range(8), range(8)]
+        self.digits = [(int(mapId) >> MapValues.nibbleShift[i]) & 0xf for i in range(8)]
 
     # Converts the digits in the map id to the values seen in this section.
     mapIdCodeTable = [
@@ -155,6 +445,43 @@ class MapValues :
     ]
 
 
+    # Bit position of nibble i (0: highest four bits) in a 32 bit value
+    nibbleShift = [28, 24, 20, 16, 12, 8, 4, 0]
+
+    @staticmethod
+    def batch(mapIds, headerLengths) :
+        """Calculates the four values for each of the map IDs at once, 
+        without creating MapValues objects. Same algorithm as calculate(), 
+        with the steps folded together. headerLengths: One header length 
+        for all IDs or a list with one per ID.
+        Returns a list of tuples (value 0, value 1, value 2, value 3)."""
+        
+        if isinstance(headerLengths, (int, long)) :
+            headerLengths = [headerLengths] * len(mapIds)
+        code = MapValues.mapIdCodeTable
+        offsetMap = MapValues.offsetMap
+        shift = MapValues.nibbleShift
+        
+        results = []
+        for (mapId, length) in zip(mapIds, headerLengths) :
+            m = int(mapId)
+            d = [(m >> shift[i]) & 0xf for i in range(8)]
+            offset = offsetMap[(d[1] + d[3] + d[5] + d[7]) & 0xf]
+            
+            # Third and fourth value: translated digits, pairwise swapped
+            v3 = [code[d[i ^ 1]] for i in range(8)]
+            v0 = (d[4] + v3[0], d[5] + v3[1], d[6] + v3[2], d[7] + v3[3], v3[4], v3[5], v3[6], v3[7] + 1)
+            v1 = (v3[0], v3[1], v3[2] + (length >> 4), v3[3] + length, v3[4] + d[0], v3[5] + d[1], v3[6] + d[2], v3[7] + d[3])
+            
+            values = []
+            for v in (v0, v1, v3, v3) :
+                res = 0
+                for i in range(8) :
+                    res |= ((v[i] + offset) & 0xf) << shift[i]
+                values.append(res)
+            results.append(tuple(values))
+        return results
+
     def value(self, n) :
         """There are four values.  Get value n.
         @param n Get value n, starting at 0 up to four."""
@@ -265,4 +592,4 @@ class MapValues :
         @param i The nibble number, 0 most significant, 7 the least.
         @return The given nibble of the map id."""
 
-        return int(('%08x' % (int(self.mapId)))[i], 16)
+        return self.digits[i]
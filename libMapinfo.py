@@ -15,11 +15,24 @@ class MapInfo(SettingsFile) :
     I_FILENAME_MAP = 'filename-map'		# Filename.
     I_DIR_SPLITS = 'directory-splits'	# Where to put the splits
     I_MAP_STAT = 'map-stat'
+    I_MAP_DIGEST = 'map-digest'		# Content digest of the osm file the tiles have been built from (see libFileHash.py)
     I_IMG_STAT = 'img-stat'
     I_MAP_NUMBER = 'map-number'
     I_STYLE_FILE = 'style-file'
     I_STYLE_HASH = 'style-hash'
     I_MAX_NODES = 'max-nodes'
+    I_TILE_PREFIX = 'tile-prefix'		# Map number the cached tiles have been compiled with
+    I_LAST_USED = 'last-used'		# Time of the last build using this map (cache eviction)
+    I_MERGED_FROM = 'merged-from'	# Input files of a merged map
+    I_REGION = 'region'			# Region the tiles have been built for, empty for the whole map
+    I_SPLITTER_SECONDS = 'splitter-seconds'	# Duration of the last splitter run
+    I_MKGMAP_SECONDS = 'mkgmap-seconds'	# Duration of the last mkgmap run
+    I_TILE_COUNT = 'tile-count'		# Number of tiles compiled in the last mkgmap run
+    
+    # Limits for choosing max-nodes automatically (see adaptiveMaxNodes)
+    defaultMaxNodes = 1600000		# Default of splitter
+    minMaxNodes = 50000
+    maxMaxNodes = 16000000
 
     def __init__(self, mapfilename, dir=os.path.join('.','xmlData'), splitDir=os.path.join('.','osmData')) :
         try :
@@ -34,6 +47,28 @@ class MapInfo(SettingsFile) :
         self.setText(MapInfo.I_FILENAME_MAP, mapfilename)
         self.setText(MapInfo.I_DIR_SPLITS, os.path.join(splitDir, self.mapID))
 
+    def adaptiveMaxNodes(self, targetSeconds) :
+        """Chooses max-nodes for splitter such that mkgmap needs about
+        targetSeconds per tile, based on the max-nodes value and the mkgmap
+        duration per tile of the last build. The compile time of a tile
+        is assumed to be proportional to its number of nodes; the change
+        per build is limited to a factor of 4."""
+        
+        try :
+            maxNodes = int(self.text(MapInfo.I_MAX_NODES))
+            seconds = float(self.text(MapInfo.I_MKGMAP_SECONDS))
+            tiles = int(self.text(MapInfo.I_TILE_COUNT))
+        except ValueError :
+            # No history yet
+            return MapInfo.defaultMaxNodes
+        if tiles <= 0 or seconds <= 0 :
+            return maxNodes
+        
+        factor = targetSeconds / (seconds / tiles)
+        factor = min(4.0, max(0.25, factor))
+        maxNodes = int(round(maxNodes * factor, -4))
+        return min(MapInfo.maxMaxNodes, max(MapInfo.minMaxNodes, maxNodes))
+
     def complete(self) :
         return not (self.empty(MapInfo.I_CNAME) or self.empty(MapInfo.I_CABBR))
         
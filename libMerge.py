@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Merges overlapping extracts (e.g. a country and its neighbours) into
+# one file before splitting, so that areas contained in several extracts
+# are compiled only once. osmium merge removes objects which are
+# contained in several inputs; it requires sorted inputs, which extracts
+# from download.geofabrik.de are.
+
+from libMapinfo import MapInfo, reMap
+import os
+
+def memberStat(files) :
+    """Sizes and modification times of the input files of a merged map."""
+    stats = []
+    for f in files :
+        st = os.stat(f)
+        stats.append('%s %d %d' % (os.path.abspath(f), st.st_size, int(st.st_mtime)))
+    return '; '.join(stats)
+
+def mergedMap(files, dirData, osmium='osmium') :
+    """Merges the given .osm.(bz2|pbf) files into dirData/<a>+<b>.osm.pbf
+    unless this has already been done with the same input files.
+    Country name and abbreviation are taken from the inputs.
+    Returns the file name of the merged map, or None on failure."""
+
+    names = [reMap.match(f).group('name') for f in files]
+    output = os.path.join(dirData, '+'.join(names) + '.osm.pbf')
+    stat = memberStat(files)
+
+    info = MapInfo(output, splitDir=dirData)
+    if os.path.exists(output) and info.text(MapInfo.I_MERGED_FROM) == stat :
+        print('Merged map %s is up to date.' % (output))
+    else :
+        cmd = '%s merge --overwrite --output=%s %s' % (osmium, output, ' '.join(files))
+        print('Merging %s: %s' % (', '.join(files), cmd))
+        if os.system(cmd) != 0 :
+            print('Error merging %s, building them separately.' % (', '.join(files)))
+            if os.path.exists(output) :
+                os.remove(output)
+            return None
+        info.setText(MapInfo.I_MERGED_FROM, stat)
+
+    # The map gets a single country name. Use the one of the inputs if
+    # they agree, otherwise the one of the first input.
+    for tag in (MapInfo.I_CNAME, MapInfo.I_CABBR) :
+        if not info.empty(tag) :
+            continue
+        values = []
+        for f in files :
+            value = MapInfo(f, splitDir=dirData).text(tag)
+            if value != '' and value not in values :
+                values.append(value)
+        if len(values) > 0 :
+            info.setText(tag, values[0])
+        if len(values) > 1 :
+            print('%s of %s differs between the inputs (%s), using %s.' % (tag, output, ', '.join(values), values[0]))
+    return output
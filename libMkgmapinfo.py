@@ -15,9 +15,11 @@ class MkgmapInfo(SettingsFile) :
     # Variables
     I_SPLITTER = 'splitter-location'
     I_MKGMAP = 'mkgmap-location'
+    I_OSMIUM = 'osmium-location'
     I_RAM_TOTAL = 'available-ram'
     I_RAM = 'available-thread-ram'
     I_THREADS = 'threads'
+    I_CACHE_BUDGET = 'cache-budget'	# MB for split files and tiles in the data directory
     
     def __init__(self, filename) :
         self.filename = filename
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Progress of the running splitter and mkgmap jobs. The splitter log of
+# each job is followed for its node/way/relation counts, mkgmap progress
+# is the number of tiles already written. The status is printed to the
+# terminal and/or served as JSON over HTTP (http://localhost:<port>/).
+
+from __future__ import with_statement
+import os
+import re
+import time
+import json
+import threading
+import BaseHTTPServer
+
+reCount = re.compile('(?i)([\d,\']+)\s+(nodes|ways|rels|relations)\\b')
+reCountAfter = re.compile('(?i)\\b(nodes|ways|rels|relations)\s*[:=]\s*([\d,\']+)')
+reTile = re.compile('\d{8}\.img$')
+
+PHASE_WAITING = 'waiting'
+PHASE_SPLITTER = 'splitter'
+PHASE_MKGMAP = 'mkgmap'
+PHASE_REMOTE = 'remote'		# Running on a worker
+PHASE_DONE = 'done'
+PHASE_FAILED = 'failed'
+
+
+class Job :
+    """Progress of one map."""
+
+    def __init__(self, name, nr, size, expected, rebuild=True) :
+        self.name = name
+        self.nr = nr
+        self.size = size		# Size of the osm file
+        self.expected = expected	# Expected duration from earlier builds, or None
+        self.rebuild = rebuild		# False if the map will probably be re-used
+        self.phase = PHASE_WAITING
+        self.started = None
+        self.phaseStarted = None
+        self.finished = None
+        self.logfile = None
+        self.logpos = 0
+        self.workdir = None
+        self.counts = {'nodes' : 0, 'ways' : 0, 'rels' : 0}
+        self.tiles = 0
+        self.tilesDone = 0
+
+    def poll(self) :
+        """Reads new lines of the splitter log and counts finished tiles."""
+        if self.phase == PHASE_SPLITTER and self.logfile is not None :
+            try :
+                with open(self.logfile, 'r') as f :
+                    f.seek(self.logpos)
+                    for line in f :
+                        self.parse(line)
+                    self.logpos = f.tell()
+            except IOError :
+                None
+        elif self.phase == PHASE_MKGMAP and self.workdir is not None :
+            try :
+                self.tilesDone = len([f for f in os.listdir(self.workdir) if reTile.match(f)])
+            except OSError :
+                None
+
+    def parse(self, line) :
+        # Either 'nodes: 1234' or '1234 nodes'
+        found = [(n, k) for (k, n) in reCountAfter.findall(line)]
+        if len(found) == 0 :
+            found = reCount.findall(line)
+        for (n, k) in found :
+            k = k.lower()
+            if k == 'relations' : k = 'rels'
+            try :
+                self.counts[k] = max(self.counts[k], int(re.sub('[,\']', '', n)))
+            except ValueError :
+                None
+
+    def elapsed(self, now) :
+        if self.started is None :
+            return 0
+        return (self.finished or now) - self.started
+
+    def status(self, now) :
+        s = {'name' : self.name, 'number' : self.nr, 'phase' : self.phase,
+            'elapsed' : round(self.elapsed(now), 1), 'tiles' : self.tiles, 'tiles-done' : self.tilesDone}
+        s.update(self.counts)
+        if self.phase == PHASE_SPLITTER and now > self.phaseStarted :
+            s['elements-per-second'] = int(sum(self.counts.values()) / (now - self.phaseStarted))
+        if self.phase == PHASE_MKGMAP and now > self.phaseStarted :
+            s['tiles-per-minute'] = round(self.tilesDone * 60.0 / (now - self.phaseStarted), 1)
+        return s
+
+
+class Progress(threading.Thread) :
+
+    def __init__(self, threads=1, interval=10, port=None, show=False) :
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.threads = threads
+        self.interval = interval
+        self.show = show
+        self.server = None
+        if port is not None :
+            self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), StatusHandler)
+            self.server.progress = self
+            t = threading.Thread(target=self.server.serve_forever)
+            t.setDaemon(True)
+            t.start()
+            print('Status available at http://127.0.0.1:%d/' % (port))
+
+    def add(self, name, nr, size, expected=None, rebuild=True) :
+        """rebuild: False if the tiles of the map will probably be re-used;
+        the map is then not counted in the ETA unless it is built after all."""
+        with self.lock :
+            self.jobs.append(Job(name, nr, size, expected, rebuild))
+
+    def job(self, nr) :
+        for j in self.jobs :
+            if j.nr == nr :
+                return j
+        return None
+
+    def phase(self, nr, phase, logfile=None, workdir=None, tiles=0) :
+        """A job enters a new phase (see PHASE_*)."""
+        with self.lock :
+            j = self.job(nr)
+            if j is None :
+                return
+            now = time.time()
+            if j.started is None :
+                j.started = now
+            j.phase = phase
+            j.phaseStarted = now
+            if phase in (PHASE_SPLITTER, PHASE_MKGMAP, PHASE_REMOTE) :
+                j.rebuild = True
+            j.logfile = logfile
+            j.logpos = 0
+            j.workdir = workdir
+            if tiles > 0 :
+                j.tiles = tiles
+            if phase in (PHASE_DONE, PHASE_FAILED) :
+                j.finished = now
+                j.tilesDone = j.tiles
+
+    def rate(self) :
+        """Bytes of osm file per second, from the expected durations."""
+        size = sum([j.size for j in self.jobs if j.expected])
+        seconds = sum([j.expected for j in self.jobs if j.expected])
+        if seconds > 0 :
+            return size / seconds
+        return None
+
+    def eta(self, now) :
+        """Estimated seconds until all jobs are finished, or None. Maps
+        which are re-used take no time worth counting."""
+        rate = self.rate()
+        left = 0.0
+        for j in self.jobs :
+            if j.phase in (PHASE_DONE, PHASE_FAILED) or not j.rebuild :
+                continue
+            expected = j.expected
+            if expected is None :
+                if rate is None :
+                    return None
+                expected = j.size / rate
+            left += max(0, expected - j.elapsed(now))
+        return left / max(1, self.threads)
+
+    def status(self) :
+        with self.lock :
+            now = time.time()
+            for j in self.jobs :
+                j.poll()
+            eta = self.eta(now)
+            return {'jobs' : [j.status(now) for j in self.jobs],
+                'done' : len([j for j in self.jobs if j.phase in (PHASE_DONE, PHASE_FAILED)]),
+                'total' : len(self.jobs),
+                'eta' : int(eta) if eta is not None else None}
+
+    def render(self) :
+        s = self.status()
+        lines = ['--- %d of %d maps done, ETA %s ---' % (s['done'], s['total'], 'unknown' if s['eta'] is None else '%d:%02d' % (s['eta'] / 60, s['eta'] % 60))]
+        for j in s['jobs'] :
+            if j['phase'] == PHASE_SPLITTER :
+                lines.append('%s \t%s: splitter, %d nodes, %d ways, %d rels, %d elements/s' % (j['number'], j['name'], j['nodes'], j['ways'], j['rels'], j.get('elements-per-second', 0)))
+            elif j['phase'] == PHASE_MKGMAP :
+                lines.append('%s \t%s: mkgmap, %d of %d tiles' % (j['number'], j['name'], j['tiles-done'], j['tiles']))
+            elif j['phase'] == PHASE_REMOTE :
+                lines.append('%s \t%s: on a worker, %d s' % (j['number'], j['name'], j['elapsed']))
+        return '\n'.join(lines)
+
+    def run(self) :
+        while True :
+            time.sleep(self.interval)
+            if self.show :
+                print(self.render())
+
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler) :
+
+    def do_GET(self) :
+        body = json.dumps(self.server.progress.status(), indent=1)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) :
+        # Do not write requests to the console
+        None
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Region of interest (bounding box or polygon) for building only the
+# tiles of a map which intersect it. Coordinates are in degrees,
+# points are (lat, lon).
+
+from __future__ import with_statement
+from libGarminImg import units2deg, fileDigest
+import os
+import re
+
+# Line of splitter's areas.list: 63240001: 2187264,339968 to 2250752,449536
+reArea = re.compile('^(\d{8}):\s*(-?\d+),(-?\d+)\s+to\s+(-?\d+),(-?\d+)')
+
+def readAreas(filename) :
+    """Reads splitter's areas.list. Returns a dictionary with the tile
+    names (8 digits) as keys and (south, west, north, east) in degrees."""
+
+    areas = {}
+    with open(filename, 'r') as f :
+        for line in f :
+            o = reArea.match(line)
+            if o is not None :
+                areas[o.group(1)] = tuple([units2deg(int(o.group(i))) for i in range(2, 6)])
+    return areas
+
+
+def inside(p, polygon) :
+    """Point in polygon test (ray casting)."""
+    lat, lon = p
+    c = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)) :
+        (lati, loni) = polygon[i]
+        (latj, lonj) = polygon[j]
+        if (loni > lon) != (lonj > lon) and lat < (latj - lati) * (lon - loni) / (lonj - loni) + lati :
+            c = not c
+        j = i
+    return c
+
+def crosses(a, b, c, d) :
+    """True if the segments a-b and c-d intersect."""
+    def ccw(p, q, r) :
+        return (r[0]-p[0]) * (q[1]-p[1]) - (q[0]-p[0]) * (r[1]-p[1])
+    d1 = ccw(c, d, a); d2 = ccw(c, d, b)
+    d3 = ccw(a, b, c); d4 = ccw(a, b, d)
+    return ((d1 > 0) != (d2 > 0)) and ((d3 > 0) != (d4 > 0))
+
+
+class Region :
+
+    def __init__(self) :
+        self.polygons = []
+        self.names = []
+
+    def addBBox(self, bbox) :
+        """bbox: 'minlat,minlon,maxlat,maxlon'"""
+        (s, w, n, e) = [float(v) for v in bbox.split(',')]
+        self.polygons.append([(s, w), (s, e), (n, e), (n, w)])
+        self.names.append('bbox=%s,%s,%s,%s' % (s, w, n, e))
+
+    def addPolygon(self, filename) :
+        """Reads an osmosis polygon file (.poly). Holes (sections starting
+        with !) are ignored, which may select some tiles too many."""
+
+        filename = os.path.abspath(filename)
+        with open(filename, 'r') as f :
+            lines = [l.strip() for l in f]
+        polygon = None
+        hole = False
+        for l in lines[1:] :
+            if l == '' :
+                continue
+            if polygon is None :
+                # Section name
+                polygon = []
+                hole = l.startswith('!')
+            elif l == 'END' :
+                if not hole and len(polygon) > 2 :
+                    self.polygons.append(polygon)
+                polygon = None
+            else :
+                (lon, lat) = [float(v) for v in l.split()[:2]]
+                polygon.append((lat, lon))
+        self.names.append('polygon=%s:%s' % (filename, fileDigest(filename)))
+
+    def empty(self) :
+        return len(self.polygons) == 0
+
+    def description(self) :
+        """Identifies the region, e.g. to decide whether tiles built for
+        a region can be re-used."""
+        return ' '.join(self.names)
+
+    def intersects(self, south, west, north, east) :
+        """True if the rectangle intersects the region."""
+
+        corners = [(south, west), (south, east), (north, east), (north, west)]
+        for polygon in self.polygons :
+            for (lat, lon) in polygon :
+                if south <= lat <= north and west <= lon <= east :
+                    return True
+            for p in corners :
+                if inside(p, polygon) :
+                    return True
+            for i in range(len(polygon)) :
+                a = polygon[i - 1]; b = polygon[i]
+                for j in range(4) :
+                    if crosses(a, b, corners[j - 1], corners[j]) :
+                        return True
+        return False
+
+    def intersectsTile(self, tile) :
+        """True if the TRE bounds of the tile (see libTileIndex.Tile)
+        intersect the region."""
+        (n, e, s, w) = [units2deg(u) for u in tile.bounds]
+        return self.intersects(s, w, n, e)
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Persistent index of the compiled map tiles (*.img). Tiles are only
+# parsed again (see libGarminImg.py) if their path, size or modification
+# time changed since they have been indexed.
+
+from __future__ import with_statement
+from lxml import etree
+from libSettingsfile import SettingsFile
+from libGarminImg import GarminImg, Subfile, mtimeNs
+import os
+import threading
+
+
+class Tile :
+    """Index entry of a single tile."""
+
+    def __init__(self, node) :
+        self.node = node
+        self.path = node.get('path')
+        self.name = os.path.basename(self.path)
+        self.size = int(node.get('size'))
+        self.mtimeNs = int(node.get('mtime-ns'))
+        self.mapId = int(node.get('map-id'))
+        self.headerLength = int(node.get('header-length'))
+        self.digest = node.get('digest')
+        if self.digest is None :
+            raise ValueError('No digest')
+        self.bounds = tuple([int(node.get(b)) for b in TileIndex.bounds])
+        self.subfiles = [Subfile(s.get('name'), s.get('type'), int(s.get('offset')), int(s.get('size'))) for s in node.findall('subfile')]
+
+    def key(self) :
+        return (self.path, self.size, self.mtimeNs)
+
+    def stat(self) :
+        """Size and modification time, to detect changes of the tile."""
+        return '%d %d' % (self.size, self.mtimeNs)
+
+
+class TileIndex(SettingsFile) :
+
+    T_TILE = 'tile'
+    T_SUBFILE = 'subfile'
+    bounds = ('north', 'east', 'south', 'west')
+
+    def __init__(self, filename) :
+        SettingsFile.__init__(self, filename, rootTag=etree.Element('pyMkgmap', src="openstreetmap.org", obj="tiles"), writeback=False, forceTag=True)
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.unreadable = set()
+        for node in self.doc.findall(TileIndex.T_TILE) :
+            try :
+                tile = Tile(node)
+                self.entries[tile.path] = tile
+            except (TypeError, ValueError) :
+                # Incomplete entry, will be re-read.
+                self.doc.remove(node)
+
+    def update(self, dir) :
+        """Indexes all *.img files in dir. Files which are unchanged
+        since the last update are not opened again, entries of removed
+        files are dropped. Returns the tiles in dir (see tiles())."""
+
+        dir = os.path.abspath(dir)
+        try :
+            files = [os.path.join(dir, f) for f in os.listdir(dir) if f.lower().endswith('.img')]
+        except OSError :
+            files = []
+
+        with self.lock :
+            known = dict([(p, self.entries[p].key()) for p in files if p in self.entries])
+
+        # Read and hash new and changed tiles without holding the lock, so
+        # other threads are not blocked while a large map is indexed
+        parsed = []
+        for path in files :
+            try :
+                st = os.stat(path)
+            except OSError :
+                continue
+            if known.get(path) == (path, st.st_size, mtimeNs(st)) :
+                continue
+            gi = GarminImg(path)
+            parsed.append((path, gi if gi.readInfo() else None, st))
+
+        with self.lock :
+            changed = False
+            for path in [p for p in self.entries if os.path.dirname(p) == dir and p not in files] :
+                self.remove(path)
+                changed = True
+            self.unreadable.difference_update([p for p in self.unreadable if os.path.dirname(p) == dir])
+
+            for (path, gi, st) in parsed :
+                self.remove(path)
+                if gi is not None :
+                    self.add(gi, st)
+                else :
+                    print('Could not read tile %s, not indexed.' % (path))
+                    self.unreadable.add(path)
+                changed = True
+
+            if changed :
+                self.write()
+
+        return self.tiles(dir)
+
+    def add(self, gi, st) :
+        node = etree.SubElement(self.doc, TileIndex.T_TILE, path=gi.filename, size=str(st.st_size),
+            digest=gi.digest)
+        node.set('mtime-ns', str(mtimeNs(st)))
+        node.set('map-id', str(gi.mapId))
+        node.set('header-length', str(gi.headerLength))
+        for i in range(4) :
+            node.set(TileIndex.bounds[i], str(gi.bounds[i]))
+        for sf in gi.subfiles :
+            etree.SubElement(node, TileIndex.T_SUBFILE, name=sf.name, type=sf.type, offset=str(sf.offset), size=str(sf.size))
+        self.entries[gi.filename] = Tile(node)
+
+    def remove(self, path) :
+        tile = self.entries.pop(path, None)
+        if tile is not None :
+            self.doc.remove(tile.node)
+
+    def tiles(self, dir, prefix=None) :
+        """Indexed tiles in dir, sorted by path. If prefix is given, only
+        tiles whose file name starts with it are returned."""
+
+        dir = os.path.abspath(dir)
+        with self.lock :
+            tiles = [t for t in self.entries.values() if os.path.dirname(t.path) == dir]
+        if prefix is not None :
+            tiles = [t for t in tiles if t.name.startswith(prefix)]
+        tiles.sort(key=lambda t : t.path)
+        return tiles
+
+    def unreadableFiles(self, dir) :
+        """*.img files in dir which could not be indexed at the last update."""
+        dir = os.path.abspath(dir)
+        with self.lock :
+            return sorted([p for p in self.unreadable if os.path.dirname(p) == dir])
+
+    def tile(self, path) :
+        with self.lock :
+            return self.entries.get(os.path.abspath(path))
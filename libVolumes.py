@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Splits the tiles of a build into several gmapsupp.img volumes of
+# limited size (e.g. for FAT32 cards or older devices) and assembles
+# them in parallel.
+
+from __future__ import with_statement
+from lxml import etree
+from libGarminImg import units2deg
+import os
+import threading
+import Queue
+
+GROUP_MAP = 'map'
+GROUP_GEO = 'geo'
+groupings = [GROUP_MAP, GROUP_GEO]
+
+maxBlocks = 0xffff	# Block numbers in the FAT are 16 bit
+blocksPerEntry = 240	# Block numbers in one FAT entry
+sizeFATEntry = 0x200
+
+def blockSizeFor(limit) :
+    """Block size of a gmapsupp.img of limit bytes: the smallest power of
+    two (at least 512) which addresses the whole file with 16 bit block
+    numbers, e.g. 64 KB for 4 GB."""
+    bs = 512
+    while (limit + bs - 1) // bs > maxBlocks :
+        bs *= 2
+    return bs
+
+def subfileSize(size, blockSize) :
+    """Bytes a subfile takes in an img with the given block size:
+    whole blocks plus the FAT entries listing them."""
+    blocks = (size + blockSize - 1) // blockSize
+    return blocks * blockSize + max(1, (blocks + blocksPerEntry - 1) // blocksPerEntry) * sizeFATEntry
+
+def itemSize(item, blockSize=512) :
+    """Estimated bytes of the tile in a volume with the given block size,
+    from the subfile sizes in the tile index. Tiles not in the index are
+    estimated as a single subfile."""
+    if item.tile is not None and len(item.tile.subfiles) > 0 :
+        return sum([subfileSize(sf.size, blockSize) for sf in item.tile.subfiles])
+    if item.tile is not None :
+        return subfileSize(item.tile.size, blockSize)
+    return subfileSize(os.path.getsize(item.path), blockSize)
+
+def mortonKey(item) :
+    """Z-order of the tile center, so neighbouring tiles are close to each
+    other when sorted."""
+    if item.tile is None :
+        return 0
+    (n, e, s, w) = [units2deg(u) for u in item.tile.bounds]
+    lat = int((((n + s) / 2.0) + 90) / 180.0 * 0xffff) & 0xffff
+    lon = int((((e + w) / 2.0) + 180) / 360.0 * 0xffff) & 0xffff
+    key = 0
+    for i in range(16) :
+        key |= ((lon >> i) & 1) << (2*i) | ((lat >> i) & 1) << (2*i + 1)
+    return key
+
+
+class Volume :
+    def __init__(self, blockSize) :
+        self.items = []
+        self.size = 0
+        self.blockSize = blockSize
+
+    def add(self, item) :
+        self.items.append(item)
+        self.size += itemSize(item, self.blockSize)
+
+
+def fill(volumes, items, limit, blockSize) :
+    """Adds the items to the last volume, starting new volumes when full."""
+    for item in items :
+        if len(volumes) == 0 or (len(volumes[-1].items) > 0 and volumes[-1].size + itemSize(item, blockSize) > limit) :
+            volumes.append(Volume(blockSize))
+        volumes[-1].add(item)
+
+def partition(imglist, limit, grouping=GROUP_MAP, volumeSize=None) :
+    """Distributes the ImgItems to volumes of at most limit bytes (tile
+    sizes rounded up to the block size of a volume of volumeSize bytes,
+    default limit; a single tile larger than limit gets its own volume).
+    GROUP_MAP keeps the tiles of a map together unless the map itself
+    exceeds the limit, GROUP_GEO fills the volumes with geographically
+    neighbouring tiles. Returns a list of Volumes."""
+
+    blockSize = blockSizeFor(volumeSize or limit)
+    volumes = []
+    if grouping == GROUP_GEO :
+        fill(volumes, sorted(imglist, key=mortonKey), limit, blockSize)
+        return volumes
+
+    maps = []
+    byMap = {}
+    for item in imglist :
+        if item.id not in byMap :
+            byMap[item.id] = []
+            maps.append(item.id)
+        byMap[item.id].append(item)
+    for id in maps :
+        items = byMap[id]
+        size = sum([itemSize(i, blockSize) for i in items])
+        if len(volumes) > 0 and volumes[-1].size + size <= limit :
+            for i in items : volumes[-1].add(i)
+        elif size <= limit :
+            volumes.append(Volume(blockSize))
+            for i in items : volumes[-1].add(i)
+        else :
+            volumes.append(Volume(blockSize))
+            fill(volumes, sorted(items, key=mortonKey), limit, blockSize)
+    return volumes
+
+
+def runParallel(cmds, threads) :
+    """Runs the shell commands with at most threads at once. Returns the
+    exit codes in the same order."""
+
+    queue = Queue.Queue()
+    rets = [None] * len(cmds)
+    for i in range(len(cmds)) :
+        queue.put(i)
+
+    def work() :
+        while True :
+            try :
+                i = queue.get_nowait()
+            except Queue.Empty :
+                return
+            print(cmds[i])
+            rets[i] = os.system(cmds[i])
+
+    workers = [threading.Thread(target=work) for i in range(max(1, min(threads, len(cmds))))]
+    for w in workers :
+        w.start()
+    for w in workers :
+        w.join()
+    return rets
+
+
+def checkVolumes(names, maxSize) :
+    """Indices of the volume files which are missing or larger than
+    maxSize bytes."""
+    failed = set()
+    for i in range(len(names)) :
+        if not os.path.exists(names[i]) :
+            failed.add(i)
+        elif os.path.getsize(names[i]) > maxSize :
+            print('Error: %s has %.1f MB, more than %.1f MB!' % (names[i], os.path.getsize(names[i]) / 1048576.0, maxSize / 1048576.0))
+            failed.add(i)
+    return failed
+
+def writeManifest(filename, volumes, names, mapNames, failed=()) :
+    """Writes an xml file listing the maps and tiles in each volume.
+    names: File names of the volumes, mapNames: Map number -> map name,
+    failed: Indices of volumes which could not be assembled or are too
+    large, marked with status="failed"."""
+
+    doc = etree.Element('pyMkgmap', src="openstreetmap.org", obj="volumes")
+    for i in range(len(volumes)) :
+        v = etree.SubElement(doc, 'volume', file=names[i], size=str(volumes[i].size), status='failed' if i in failed else 'ok')
+        if os.path.exists(names[i]) :
+            v.set('file-size', str(os.path.getsize(names[i])))
+        maps = {}
+        for item in volumes[i].items :
+            if item.id not in maps :
+                maps[item.id] = etree.SubElement(v, 'map', number=str(item.id), name=mapNames.get(item.id, ''))
+            etree.SubElement(maps[item.id], 'tile', file=item.path, size=str(itemSize(item, volumes[i].blockSize)))
+    with open(filename, 'w') as f :
+        f.write(etree.tostring(doc, encoding='utf-8', pretty_print=True))
@@ -8,12 +8,15 @@
 # REQUIRES
 # * Python 2.6 (not 3.x) <http://python.org/>, 
 # * libSettingsfile.py, libMapinfo.py, libMkgmapinfo.py, libArgreader.py,
-#   libGarminImg.py
+#   libGarminImg.py, libTileIndex.py, libCache.py, libMerge.py, libRegion.py,
+#   libVolumes.py, libProgress.py, libBuild.py, libDistributed.py,
+#   libFileHash.py
 # * lxml (package python-lxml on Linux).
 #   For Windows: http://codespeak.net/lxml/installation.html
 #   (Use easy_install)
 # * Additionally: mkgmap.jar and splitter.jar, see
 #   <http://www.mkgmap.org.uk/page/main>
+# * For merging maps (--merge): osmium, see <http://osmcode.org/osmium-tool/>
 
 # What does this program do?
 # 
@@ -40,13 +43,25 @@ import re # Regular Expressions
 import glob # Listing files
 import urllib # URLs
 import threading # Multi Threading
+import time
 import Queue # Task Queue
+import shutil # Moving files
+import tempfile # Scratch directories
 
 from optparse import OptionParser
-from libMapinfo import MapInfo
+from libMapinfo import MapInfo, reMap as reMapName
 from libMkgmapinfo import MkgmapInfo
-from libGarminImg import GarminImg
+from libGarminImg import GarminImg, MapValues, verifyImgs
+from libTileIndex import TileIndex
+from libFileHash import DigestCache
 from libDirHash import dirHash
+from libCache import collectGarbage, printGarbage
+from libMerge import mergedMap
+from libRegion import Region
+from libBuild import BuildJob, runBuild
+from libDistributed import Coordinator, Worker, TileStore
+from libVolumes import partition, runParallel, checkVolumes, writeManifest, groupings
+import libProgress
 
 
 # Set up variables
@@ -57,22 +72,28 @@ dirData = 'osmData'
 log = 'log-mkgmap.txt'
 wd = os.getcwdu() # Working directory
 fail = 'failed'
+volumeManifest = 'gmapsupp-manifest.xml'
+volumeOverhead = 1048576 # Bytes reserved in each volume for the TYP file and the gmapsupp directory
+scratchFactor = 3 # Space needed on the scratch directory, relative to the size of the osm file
 
 # License information for geonames file: http://download.geonames.org/export/dump/
 geonamesUrl = 'http://download.geonames.org/export/dump/cities15000.zip'
 geonames = os.path.join(dirData, re.search('/([^/]+)$',geonamesUrl).group(1))
 reImgname = re.compile('(.*)(\d{4})(\d{4}\.img)')
-reImgNr = re.compile('\d{4}(\d{4})')
 imglist = []
 
 
 parser = OptionParser(usage='Usage: %prog [options] [.osm.(bz2|pbf) files] [.maplist files]\n\
+       %prog [options] gc\n\
 \t.osm.(bz2|pbf) files\n\
 \t\tYou can get them from e.g. http://download.geofabrik.de/osm/ \n\
 \t\tor http://downloads.cloudmade.com/.\n\n\
 \t.maplist files\n\
 \t\tPlain text files with a map filename on each line.\n\
-\t\tWill add the maps given there to the list.')
+\t\tWill add the maps given there to the list.\n\n\
+\tgc\n\
+\t\tRemove split files and tiles of least recently used maps until \n\
+\t\tthe data directory fits into the cache budget.')
 parser.add_option('--nogeonames', action='store_false', default=True, dest='bGeonames', help='Do not use geonames file for city entries. (Is otherwise downloaded automatically if not available)')
 parser.add_option('--noreuse', action='store_true', default=False, dest='bNoReuse', help='Do not re-use already compiled images, also if they are identical')
 parser.add_option('--backup', action='store_true', default=False, dest='bBackup', help='Create a backup of all settings. TODO (not yet implemented)')
@@ -80,11 +101,35 @@ parser.add_option('-s', '--style-file', action='store', dest='fStyle', help='Opt
 parser.add_option('-t', '--typ-file', action='store', dest='fTyp', help='Optional TYP file')
 parser.add_option('-f', '--family-id', action='store', default="1", dest='sFamId', help='Optional family ID (shall match with TYP file)')
 parser.add_option('-n', '--max-nodes', action='store', dest='iMaxNodes', help='Maximum nodes per map segment')
+parser.add_option('-a', '--adaptive-max-nodes', action='store', type='float', dest='fTileSeconds', help='Choose the maximum nodes per map segment for each map such that mkgmap needs about this many seconds per segment, based on the last build (ignored if --max-nodes is given)')
+parser.add_option('--cache-budget', action='store', type='int', dest='iCacheBudget', help='Disk space in MB for split files and tiles of all maps; least recently used ones are removed (stored in the configuration)')
+parser.add_option('--scratch-dir', action='store', dest='dScratch', help='Directory for split files and mkgmap temporary files, e.g. /dev/shm. Only the final images are moved to %s. Not used if it has too little space left.' % (dirData))
+parser.add_option('--merge', action='store_true', default=False, dest='bMerge', help='Merge all maps into one before splitting, so overlapping areas are only compiled once (requires osmium)')
+parser.add_option('--merge-group', action='append', default=[], dest='lMergeGroups', help='Comma separated list of maps to merge into one before splitting. May be given several times.')
+parser.add_option('--bbox', action='store', dest='sBBox', help='Only build tiles intersecting this bounding box: minlat,minlon,maxlat,maxlon')
+parser.add_option('--polygon', action='store', dest='fPolygon', help='Only build tiles intersecting the polygon in this file (osmosis .poly format)')
+parser.add_option('--volume-size', action='store', type='int', dest='iVolumeSize', help='Split the gmapsupp.img into volumes gmapsupp-01.img, ... of at most this many MB, assembled in parallel')
+parser.add_option('--volume-grouping', action='store', type='choice', choices=groupings, default=groupings[0], dest='sVolumeGrouping', help='Fill the volumes map by map (map) or with neighbouring tiles (geo). Default: %default')
+parser.add_option('--progress', action='store_true', default=False, dest='bProgress', help='Print the progress of splitter and mkgmap and the estimated remaining time every 10 seconds')
+parser.add_option('--status-port', action='store', type='int', dest='iStatusPort', help='Serve the progress as JSON on http://127.0.0.1:<port>/')
+parser.add_option('--coordinator', action='store', type='int', dest='iCoordinatorPort', help='Distributed build: Do not run splitter and mkgmap here but send the jobs to workers connecting on this port (requires --tile-store)')
+parser.add_option('--coordinator-host', action='store', default='127.0.0.1', dest='sCoordinatorHost', help='Distributed build: Address the coordinator listens on, e.g. 0.0.0.0 for all interfaces. There is no authentication, only use trusted networks. Default: %default')
+parser.add_option('--worker', action='store', dest='sCoordinator', help='Distributed build: Run jobs for the coordinator at host:port (requires --tile-store)')
+parser.add_option('--tile-store', action='store', dest='dTileStore', help='Directory shared by the coordinator and the workers for exchanging tiles')
 parser.add_option('-c', '--read-config', action='store', dest='fMkgmapConfig', help='Optional mkgmap configuration file (the --read-config= option passed to mkgmap)')
 (options, args) = parser.parse_args()
 
 if options.fStyle is not None : options.fStyle = os.path.abspath(options.fStyle)
 if options.fTyp is not None : options.fTyp = os.path.abspath(options.fTyp)
+if options.dScratch is not None : options.dScratch = os.path.abspath(options.dScratch)
+
+region = Region()
+try :
+    if options.sBBox is not None : region.addBBox(options.sBBox)
+    if options.fPolygon is not None : region.addPolygon(options.fPolygon)
+except (ValueError, IOError) as e :
+    print('Cannot read region: %s' % (e))
+    sys.exit()
 
 
 
@@ -94,10 +139,30 @@ if not os.path.exists(dirXml) :
     os.mkdir(dirXml)
 if not os.path.exists(dirData) :
     os.mkdir(dirData)
+tileIndex = TileIndex(os.path.join(dirXml, 'tile-index.xml'))
+digestCache = DigestCache(os.path.join(dirXml, 'digest-cache.xml'))
+if options.iCacheBudget is not None :
+    mki.setText(MkgmapInfo.I_CACHE_BUDGET, options.iCacheBudget)
+
+def gc(keep=[]) :
+    """Enforce the cache budget, if there is one."""
+    if mki.empty(MkgmapInfo.I_CACHE_BUDGET) :
+        print('No cache budget set (--cache-budget).')
+        return
+    budget = int(mki.text(MkgmapInfo.I_CACHE_BUDGET))
+    print('Cache budget: %d MB' % (budget))
+    (total, freed, evicted) = collectGarbage(dirData, dirXml, budget*1048576, keep)
+    printGarbage(total, freed, evicted)
+    
+if len(args) > 0 and args[0] == 'gc' :
+    gc()
+    sys.exit()
 if mki.empty(MkgmapInfo.I_SPLITTER) :
     mki.setText(MkgmapInfo.I_SPLITTER, 'splitter.jar')
 if mki.empty(MkgmapInfo.I_MKGMAP) :
     mki.setText(MkgmapInfo.I_MKGMAP, 'mkgmap.jar')
+if mki.empty(MkgmapInfo.I_OSMIUM) :
+    mki.setText(MkgmapInfo.I_OSMIUM, 'osmium')
 if mki.empty(MkgmapInfo.I_THREADS) :
     threads = raw_input('How many threads should we use? \nNote that the available RAM will be divided by the number of threads.\nThe more threads, the less RAM for each thread. \n> threads (1): ')
     try :
@@ -156,6 +221,21 @@ splitter = mki.text(MkgmapInfo.I_SPLITTER)
 ram = mki.text(MkgmapInfo.I_RAM)
 threads = int(mki.text(MkgmapInfo.I_THREADS))
 
+progress = libProgress.Progress(threads, port=options.iStatusPort, show=options.bProgress)
+
+coordinator = None
+tileStore = None
+if options.iCoordinatorPort is not None or options.sCoordinator is not None :
+    if options.dTileStore is None :
+        print('A distributed build requires --tile-store.')
+        sys.exit()
+    tileStore = TileStore(options.dTileStore)
+if options.sCoordinator is not None :
+    Worker(options.sCoordinator, tileStore, splitter, mkgmap, ram, options.dScratch).run()
+    sys.exit()
+if options.iCoordinatorPort is not None :
+    coordinator = Coordinator(options.iCoordinatorPort, options.sCoordinatorHost)
+
 def word(w) :
     """Without spaces at the beginning and end."""
     o = re.search('^\s*(\w.*?\w?)\s*$', w)
@@ -164,6 +244,15 @@ def word(w) :
         val = o.group(1)
     return val
 
+def sameStat(stat, filename) :
+    """True if size and modification time in stat (str(os.stat()) as
+    written by older versions) are the ones of the file."""
+    o = re.search('st_size=(\d+)L?, .*st_mtime=(\d+)', stat)
+    if o is None :
+        return False
+    st = os.stat(filename)
+    return int(o.group(1)) == st.st_size and int(o.group(2)) == int(st.st_mtime)
+
 
 
 
@@ -174,14 +263,16 @@ def word(w) :
 
 
 class ImgItem :
-    def __init__(self, path, id) :
+    def __init__(self, path, id, tile=None) :
         self.path = path
         self.id = id
+        self.tile = tile
 
 class MapThread(threading.Thread) :
     
     MapLock = threading.Lock()
     MapQueue = Queue.Queue()
+    ScratchReserved = 0	# Bytes in the scratch directory promised to running maps
     
     def run(self) :
         while True :
@@ -199,29 +290,83 @@ class MapThread(threading.Thread) :
             self.osmfile = os.path.join(wd, self.map.text(MapInfo.I_FILENAME_MAP))
             MapThread.MapLock.release()
             
-            self.filesGz = ''
-            
-            self.makeMap()
-            
-            MapThread.MapQueue.task_done()
+            try :
+                self.makeMap()
+            finally :
+                # Otherwise the main thread waits forever
+                MapThread.MapQueue.task_done()
+    
+    def workDir(self) :
+        """Directory for splitter and mkgmap: A new directory in the scratch
+        directory if there is enough space left, otherwise the split directory.
+        The space is reserved until releaseWorkDir() is called."""
+        
+        self.scratchReserved = 0
+        if options.dScratch is None :
+            return self.sdir
+        needed = scratchFactor * os.path.getsize(self.osmfile)
+        with MapThread.MapLock :
+            try :
+                st = os.statvfs(options.dScratch)
+                free = st.f_bavail * st.f_frsize - MapThread.ScratchReserved
+            except (AttributeError, OSError) :
+                # No statvfs on Windows
+                print('%sCannot determine free space in %s, not using it.' % (self.spid, options.dScratch))
+                return self.sdir
+            if free < needed :
+                print('%sOnly %d MB free in %s for this map (need %d MB), using %s instead.' % (self.spid, max(0, free)/1048576, options.dScratch, needed/1048576, self.sdir))
+                return self.sdir
+            MapThread.ScratchReserved += needed
+            self.scratchReserved = needed
+        return tempfile.mkdtemp(prefix='%s-' % (self.map.mapID), dir=options.dScratch)
+    
+    def releaseWorkDir(self, wdir) :
+        """Removes a scratch directory returned by workDir() and releases its space."""
+        
+        if wdir == self.sdir :
+            return
+        # Remove split files and temporary files from the scratch directory
+        shutil.rmtree(wdir, True)
+        with MapThread.MapLock :
+            MapThread.ScratchReserved -= self.scratchReserved
+            self.scratchReserved = 0
         
     def makeMap(self) :
         
         print('\n%sProcessing: %s.' % (self.spid, self.map.text(MapInfo.I_FILENAME_MAP)))
         self.err = False
+        self.map.setText(MapInfo.I_LAST_USED, int(time.time()))
+        self.maxNodes = options.iMaxNodes
+        if self.maxNodes is None and options.fTileSeconds is not None :
+            # Keep the value the available images have been built with
+            self.maxNodes = self.map.text(MapInfo.I_MAX_NODES)
         
         
         # Check whether maps can be re-used without re-compiling #
-        self.imgfilelist = glob.glob(os.path.join(self.sdir, '*.img'))
+        # The cached tiles are the ones written by mkgmap and carry the map
+        # number of that build. They are never modified; tiles for other
+        # map numbers are copies next to them.
+        self.tiles = tileIndex.update(self.sdir)
+        self.tilePrefix = self.map.text(MapInfo.I_TILE_PREFIX)
+        if self.tilePrefix == '' and len(self.tiles) > 0 :
+            # Cache of an older version which renamed the tiles in place.
+            self.o = reImgname.match(self.tiles[0].path)
+            if self.o is not None :
+                self.tilePrefix = self.o.group(2)
+        self.tiles = [t for t in self.tiles if reImgname.match(t.path) is not None and reImgname.match(t.path).group(2) == self.tilePrefix]
+        self.imgfilelist = [t.path for t in self.tiles]
         self.available = False
-        self.osmStat = str(os.stat(self.osmfile))
+        self.osmDigest = digests.get(os.path.abspath(self.osmfile))
+        if self.map.empty(MapInfo.I_MAP_DIGEST) and self.osmDigest is not None and sameStat(self.map.text(MapInfo.I_MAP_STAT), self.osmfile) :
+            # Built by an older version which only stored os.stat()
+            self.map.setText(MapInfo.I_MAP_DIGEST, self.osmDigest)
         
         if self.map.text(MapInfo.I_MAP_STAT) == fail :
             print('%sBuilding this map failed last time.' % (self.spid))
         
         if options.bNoReuse :
             print('%sReuse of %s not desired.' % (self.spid, self.osmfile))
-        elif self.osmStat != self.map.text(MapInfo.I_MAP_STAT) :
+        elif self.map.text(MapInfo.I_MAP_STAT) == fail or self.osmDigest is None or self.osmDigest != self.map.text(MapInfo.I_MAP_DIGEST) :
             print('%sThe osm file %s has changed in the meantime, need to rebuild it.' % (self.spid, self.osmfile))
         elif len(self.imgfilelist) <= 0:
             print('%sNo image files available for %s, need to build them.' % (self.spid, self.osmfile))
@@ -231,114 +376,162 @@ class MapThread(threading.Thread) :
             print('%sStyle has been altered, map needs to be rebuilt.' % (self.spid))
         elif str(options.iMaxNodes) < self.map.text(MapInfo.I_MAX_NODES) :
             print('%sMaximum nodes have decreased from %s to %s, map needs to be rebuilt.' % (self.spid, self.map.text(MapInfo.I_MAX_NODES), options.iMaxNodes))
+        elif not self.map.empty(MapInfo.I_REGION) and self.map.text(MapInfo.I_REGION) != region.description() :
+            print('%sAvailable images only cover %s, map needs to be rebuilt.' % (self.spid, self.map.text(MapInfo.I_REGION)))
         else :
             # May be able to re-use map. 
-            self.stat = str(os.stat(self.imgfilelist[0]))
+            self.stat = self.tiles[0].stat()
+            if self.stat != self.map.text(MapInfo.I_IMG_STAT) and sameStat(self.map.text(MapInfo.I_IMG_STAT), self.tiles[0].path) :
+                # Written by an older version as str(os.stat())
+                self.map.setText(MapInfo.I_IMG_STAT, self.stat)
+            self.suspect = {}
             if self.stat == self.map.text(MapInfo.I_IMG_STAT) :
+                self.suspect = verifyImgs(self.imgfilelist, threads)
+                for self.file in tileIndex.unreadableFiles(self.sdir) :
+                    self.suspect[self.file] = ['Not readable']
+                for self.file in sorted(self.suspect) :
+                    print('%sSuspect tile %s: %s' % (self.spid, self.file, '; '.join(self.suspect[self.file])))
+            if len(self.suspect) > 0 :
+                print('%s%d damaged tiles, need to rebuild.' % (self.spid, len(self.suspect)))
+            elif self.stat == self.map.text(MapInfo.I_IMG_STAT) :
                 
                 print('%sMap did not change since last time; Re-using it.' % (self.spid))
-                print('%sRenaming original files %s if necessary.' % (self.spid, self.imgfilelist))
-                for self.file in self.imgfilelist :
-                    
+                if self.tilePrefix != self.prefix :
+                    print('%sCopying original files %s for map number %s if necessary.' % (self.spid, self.imgfilelist, self.mapNr))
+                    # Hash values of the new map IDs, calculated at once
+                    self.values = MapValues.batch([self.prefix + reImgname.match(t.path).group(3)[:4] for t in self.tiles], [t.headerLength for t in self.tiles])
+                    for (self.tile, values) in zip(self.tiles, self.values) :
+                        if not region.empty() and not region.intersectsTile(self.tile) :
+                            continue
+                        self.o = reImgname.match(self.tile.path)
+                        id = self.prefix + self.o.group(3)[:4]
+                        self.file = self.o.group(1) + self.prefix + self.o.group(3)
+                        t = tileIndex.tile(self.file)
+                        if t is not None and t.mapId == int(id) and t.mtimeNs >= self.tile.mtimeNs :
+                            # Copy from an earlier run, no need to open it.
+                            continue
+                        if GarminImg(self.tile.path).copyWithID(id, self.file, self.spid, values) is None :
+                            self.err = True
+                # Copies for other map numbers of earlier runs are not needed any more
+                for self.file in glob.glob(os.path.join(self.sdir, '*.img')) :
                     self.o = reImgname.match(self.file)
-                    
-                    if self.o is not None :
-                        # Change ID in the file itself
-                        id = self.prefix + reImgNr.search(self.file).group(1)
-                        gi = GarminImg(self.file)
-                        t = gi.rename(id, self.spid)
-                        if not t == None :
-                            print('%sReplaced old map ID (%s) with new one (%s) %s times \n%sin %s.' % (self.spid, t[2], id, t[0], self.spids, self.file))
-                        # Change filename
-                        os.rename(self.file, self.o.group(1) + self.prefix + self.o.group(3))
-                        print('%sRenamed %s \n%sto %s.' % (self.spid, self.file, self.spids, self.o.group(1) + self.prefix + self.o.group(3)))
-                        
-                self.available = True
+                    if self.o is not None and self.o.group(2) not in (self.tilePrefix, self.prefix) :
+                        print('%sRemoving old copy %s.' % (self.spid, self.file))
+                        os.remove(self.file)
+                tileIndex.update(self.sdir)
+                
+                self.available = not self.err
             else :
                 print("%sMap info changed from \n%s%s to \n%s%s, cannot re-use, need to rebuild." % (self.spid, self.spids, self.map.text(MapInfo.I_IMG_STAT), self.spids, self.stat))
-        self.imgfilelist = None; self.stat = None; self.osmStat = None; self.o = None; self.file = None;
+        self.imgfilelist = None; self.tiles = None; self.tile = None; self.values = None; self.suspect = None; self.stat = None; self.o = None; self.file = None;
 
         # We need to re-build the map.
         if not self.available :
-            # Split the map into smaller files
-            self.filter = '*.osm.pbf'
-            self.filelist = glob.glob(os.path.join(self.sdir, self.filter))
-            if len(self.filelist) > 0 :
-                print('%sRemoving %s: %s' % (self.spid, self.filter, self.filelist))
-                for self.file in self.filelist :
-                    os.remove(self.file)
-            self.args = ''
-            if options.bGeonames : self.args += ' --geonames-file=%s' % (os.path.join(wd, geonames))
-            if options.iMaxNodes is not None : self.args += ' --max-nodes=%s' % (options.iMaxNodes)
-            cmd = 'cd %s && java -Xmx%s -jar %s --mapid=%s --status-freq=1 %s %s 1>%s' % (self.sdir, ram, splitter, self.id, self.args, self.osmfile, log)
-            print('%sSplitter: %s' % (self.spid, cmd))
-            self.ret = os.system(cmd)
-            self.filter = None; self.filelist = None; self.args = None; self.file = None
-            
-            if self.ret != 0 :
-                print('%sError running splitter! Cannot build map %s.' % (self.spid, self.osmfile))
-                self.available = False
-                self.err = True
-            else :
-                self.ret = None
-                
-                self.filelist = glob.glob(os.path.join(self.sdir, '*.osm.pbf'))
-                print('%sSplit map files are %s' % (self.spid, self.filelist))
-                for self.item in self.filelist :
-                    self.filesGz += ' ' + self.item
-                self.filelist = None; self.item = None;
-                
-                # Remove old .img files
-                self.filter = '*.img'
+            # Remove old split files and images
+            for self.filter in ('*.osm.pbf', '*.img') :
                 self.filelist = glob.glob(os.path.join(self.sdir, self.filter))
                 if len(self.filelist) > 0 :
                     print('%sRemoving %s: %s' % (self.spid, self.filter, self.filelist))
                     for self.file in self.filelist :
                         os.remove(self.file)
-                self.filter = None; self.filelist = None; self.file = None
-                    
-                # Create a .img file for this map
-                print('%swd: %s' % (self.spid, os.getcwd()))
-                self.args = ''
-                if options.fStyle is not None : self.args += " --style-file=%s" % (options.fStyle)
-                cmd = 'cd %s && java -enableassertions -Xmx%s -jar %s --route  --remove-short-arcs --add-pois-to-areas --index --adjust-turn-headings --check-roundabouts --merge-lines --keep-going --remove-short-arcs --latin1 --route --make-opposite-cycleways --add-pois-to-areas --preserve-element-order --location-autofill=1 --country-name="%s" --country-abbr=%s --family-name="map_%s" %s -n %s %s' % (self.sdir, mki.text(MkgmapInfo.I_RAM), mkgmap, self.map.text(MapInfo.I_CNAME, 'COUNTRY'), self.map.text(MapInfo.I_CABBR, 'ABC'), self.map.text(MapInfo.I_CABBR, 'ABC'), self.args, self.id, self.filesGz)
-                print('%smkgmap:%s', (self.spid, cmd))
-                ret = os.system(cmd)
+            self.filter = None; self.filelist = None; self.file = None
+            
+            self.args = ''
+            if options.bGeonames : self.args += ' --geonames-file=%s' % (os.path.join(wd, geonames))
+            if options.iMaxNodes is None and options.fTileSeconds is not None :
+                self.maxNodes = self.map.adaptiveMaxNodes(options.fTileSeconds)
+                print('%sUsing max-nodes %s (was %s)' % (self.spid, self.maxNodes, self.map.text(MapInfo.I_MAX_NODES)))
+            if self.maxNodes is not None : self.args += ' --max-nodes=%s' % (self.maxNodes)
+            self.job = BuildJob(self.map.mapID, self.id, self.osmfile, self.args, None, options.sBBox, options.fPolygon)
+            self.args = '--country-name="%s" --country-abbr=%s --family-name="map_%s"' % (self.map.text(MapInfo.I_CNAME, 'COUNTRY'), self.map.text(MapInfo.I_CABBR, 'ABC'), self.map.text(MapInfo.I_CABBR, 'ABC'))
+            if options.fStyle is not None : self.args += " --style-file=%s" % (options.fStyle)
+            self.job.mkgmapArgs = self.args
+            self.args = None
+            
+            if coordinator is not None :
+                # Built by a worker, tiles are fetched from the tile store
+                progress.phase(self.mapNr, libProgress.PHASE_REMOTE)
+                self.result = coordinator.run(self.job)
+                if self.result['ok'] :
+                    try :
+                        for (self.file, digest) in self.result['tiles-stored'].items() :
+                            tileStore.get(digest, os.path.join(self.sdir, self.file))
+                        print('%sFetched %d tiles from %s.' % (self.spid, len(self.result['tiles-stored']), tileStore.dir))
+                    except (IOError, OSError, ValueError) as e :
+                        print('%sCannot fetch tile %s from %s: %s' % (self.spid, self.file, tileStore.dir, e))
+                        self.result['ok'] = False
+                    self.file = None
+            else :
+                self.wdir = self.workDir()
+                self.tmpdir = None
+                if self.wdir != self.sdir : self.tmpdir = self.wdir
+                self.result = runBuild(self.job, self.wdir, os.path.join(self.sdir, log), splitter, mkgmap, ram, self.tmpdir, lambda phase, **args : progress.phase(self.mapNr, phase, **args), self.spid)
                 
-                # Write .img file status
-                if ret == 0 :
-                    self.map.setText(MapInfo.I_MAP_STAT, str(os.stat(self.osmfile)))
-                    self.available = True
+                if self.result['ok'] and self.wdir != self.sdir :
+                    # Only the tiles are kept
+                    for self.file in glob.glob(os.path.join(self.wdir, '*.img')) :
+                        if reImgname.match(self.file) is not None :
+                            shutil.move(self.file, self.sdir)
+                    self.file = None
+                self.releaseWorkDir(self.wdir)
+                self.wdir = None; self.tmpdir = None
+            
+            # Durations, for choosing max-nodes and estimating the build time next time
+            if self.result.get('splitter-seconds') is not None :
+                self.map.setText(MapInfo.I_SPLITTER_SECONDS, '%.1f' % (self.result['splitter-seconds']))
+            if self.result.get('mkgmap-seconds') is not None :
+                self.map.setText(MapInfo.I_MKGMAP_SECONDS, '%.1f' % (self.result['mkgmap-seconds']))
+                self.map.setText(MapInfo.I_TILE_COUNT, self.result['tiles'])
+            
+            # Write .img file status
+            if self.result['ok'] :
+                self.map.setText(MapInfo.I_MAP_STAT, str(os.stat(self.osmfile)))
+                if self.osmDigest is not None :
+                    self.map.setText(MapInfo.I_MAP_DIGEST, self.osmDigest)
+                self.tilePrefix = self.prefix
+                if region.empty() :
+                    if self.map.removeTag(MapInfo.I_REGION) : self.map.write()
                 else :
-                    # Error encountered.
-                    print('%sError building map %s!' % (self.spid, self.osmfile))
-                    self.available = False
-                    self.err = True
+                    self.map.setText(MapInfo.I_REGION, region.description())
+                self.available = True
+            else :
+                # Error encountered.
+                self.available = False
+                self.err = True
+            self.job = None; self.result = None
 
         if self.err == True :
             self.map.setText(MapInfo.I_MAP_STAT, fail)
+            progress.phase(self.mapNr, libProgress.PHASE_FAILED)
             
         elif self.available == True :
             # Add .img files to the gmapsupp list
-            self.filelist = glob.glob(os.path.join(self.sdir, '*.img'))
-            for self.file in self.filelist :
+            tileIndex.update(self.sdir)
+            self.tiles = tileIndex.tiles(self.sdir, self.prefix)
+            if not region.empty() :
+                self.tiles = [t for t in self.tiles if region.intersectsTile(t)]
+            self.filelist = [t.path for t in self.tiles]
+            for self.tile in self.tiles :
                 MapThread.MapLock.acquire()
-                if reImgname.match(self.file) is not None :
+                if reImgname.match(self.tile.path) is not None :
                     # Only accept valid file names (\d{8}.img)
-                    imglist.append(ImgItem(self.file, self.mapNr))
+                    imglist.append(ImgItem(self.tile.path, self.mapNr, self.tile))
                 MapThread.MapLock.release()
             
             # Update the last used values to detect changes next time
             self.map.setText(MapInfo.I_STYLE_FILE, options.fStyle)
-            self.map.setText(MapInfo.I_MAX_NODES, options.iMaxNodes)
+            self.map.setText(MapInfo.I_MAX_NODES, self.maxNodes)
             if options.fStyle is not None :
                 self.map.setText(MapInfo.I_STYLE_HASH, dirHash(options.fStyle))
             
-            if len(self.filelist) > 0 :
-                # Write map file status
-                self.map.setText(MapInfo.I_IMG_STAT, str(os.stat(self.filelist[0])))
+            self.map.setText(MapInfo.I_TILE_PREFIX, self.tilePrefix)
+            self.tiles = tileIndex.tiles(self.sdir, self.tilePrefix)
+            if len(self.tiles) > 0 :
+                # Write map file status of the cached (original) tiles
+                self.map.setText(MapInfo.I_IMG_STAT, self.tiles[0].stat())
+            progress.phase(self.mapNr, libProgress.PHASE_DONE, tiles=len(self.filelist))
             print('%sProcess FINISHED. Images: %s' % (self.spid, self.filelist))
-            self.filelist = None; self.file = None;
+            self.filelist = None; self.tiles = None; self.tile = None;
         else :
             print('%sHow did we get there? Might be an error.' % (self.spid))
             None # Because of error
@@ -399,6 +592,39 @@ if len(maplist) == 0:
     sys.exit()
 
 
+# Merge overlapping maps if desired
+groups = []
+if options.bMerge and len(maplist) > 1 :
+    groups.append(list(maplist))
+for group in options.lMergeGroups :
+    group = [g.strip() for g in group.split(',') if len(g.strip()) > 0]
+    missing = [g for g in group if not os.path.exists(g)]
+    # Same pattern as used by mergedMap() for the map names
+    invalid = [g for g in group if reMapName.match(g) is None]
+    if len(missing) > 0 :
+        print('Cannot merge %s: Missing %s' % (', '.join(group), ', '.join(missing)))
+    elif len(invalid) > 0 :
+        print('Cannot merge %s: Not a .osm.(bz2|pbf) file: %s' % (', '.join(group), ', '.join(invalid)))
+    elif len(group) > 1 :
+        groups.append(group)
+grouped = []
+for group in groups :
+    # Each map is only merged once, otherwise its area would be compiled twice
+    twice = [g for g in group if os.path.abspath(g) in grouped]
+    if len(twice) > 0 :
+        print('Not merging %s again, already merged.' % (', '.join(twice)))
+        group = [g for g in group if g not in twice]
+        if len(group) < 2 :
+            continue
+    grouped += [os.path.abspath(g) for g in group]
+    merged = mergedMap(group, dirData, mki.text(MkgmapInfo.I_OSMIUM))
+    if merged is not None :
+        group = [os.path.abspath(g) for g in group]
+        maplist = [m for m in maplist if os.path.abspath(m) not in group]
+        maplist.append(merged)
+groups = None; grouped = None
+
+
 # Download geonames file if necessary and requested
 if options.bGeonames :
     if not os.path.exists(geonames) :
@@ -436,27 +662,49 @@ if len(mapinfolist) == 0 :
     print('No input maps (*.osm.(bz2|pbf)) given, exiting.')
     sys.exit()
 
+# Digests of the osm files, for detecting changed maps
+digests = digestCache.digests([os.path.join(wd, m.text(MapInfo.I_FILENAME_MAP)) for m in mapinfolist], threads)
+
 # Build maps
 n=0
-mapThreads = [MapThread() for i in range(threads)]
+if coordinator is not None :
+    # Threads only wait for the workers
+    mapThreads = [MapThread() for i in range(max(threads, len(mapinfolist)))]
+else :
+    mapThreads = [MapThread() for i in range(threads)]
 for thread in mapThreads :
     thread.setDaemon(True)
     thread.start()
 for map in mapinfolist :
     n = n+1
     map.setText(MapInfo.I_MAP_NUMBER, n)
+    try :
+        expected = float(map.text(MapInfo.I_SPLITTER_SECONDS)) + float(map.text(MapInfo.I_MKGMAP_SECONDS))
+    except ValueError :
+        expected = None
+    # Guess whether the map will be re-used; makeMap() decides
+    rebuild = options.bNoReuse or map.text(MapInfo.I_MAP_STAT) == fail \
+        or digests.get(os.path.abspath(os.path.join(wd, map.text(MapInfo.I_FILENAME_MAP)))) != map.text(MapInfo.I_MAP_DIGEST)
+    progress.add(map.mapID, map.text(MapInfo.I_MAP_NUMBER), os.path.getsize(map.text(MapInfo.I_FILENAME_MAP)), expected, rebuild)
+if options.bProgress or options.iStatusPort is not None :
+    progress.start()
+for map in mapinfolist :
     MapThread.MapQueue.put(map)
 MapThread.MapQueue.join()
 print('')
 
 
-try :
-    os.remove('gmapsupp.img')
-except OSError :
-    None
+for f in ['gmapsupp.img', volumeManifest] + glob.glob('gmapsupp-[0-9][0-9].img') :
+    try :
+        os.remove(f)
+    except OSError :
+        None
 
 
 # Create gmapsupp.img from all .img files
+# The threads add the tiles in the order they finish; sort them so that
+# volumes and manifest are the same on every run.
+imglist.sort(key=lambda item : (int(item.id), item.path))
 list = '['
 for img in imglist :
     list += img.path + ', '
@@ -473,6 +721,37 @@ args = ""
 if options.fTyp is not None : args += options.fTyp
 if options.fMkgmapConfig is not None : args += " --read-config=%s" % (options.fMkgmapConfig)
 
-cmd = 'java -Xmx%s -jar %s --gmapsupp --family-id=%s %s %s' % (mki.text(MkgmapInfo.I_RAM), mkgmap, options.sFamId, files, args)
-print(cmd)
-os.system(cmd)
+if options.iVolumeSize is None :
+    cmd = 'java -Xmx%s -jar %s --gmapsupp --family-id=%s %s %s' % (mki.text(MkgmapInfo.I_RAM), mkgmap, options.sFamId, files, args)
+    print(cmd)
+    os.system(cmd)
+else :
+    # Several volumes, each one assembled in its own directory
+    limit = options.iVolumeSize*1048576 - volumeOverhead
+    if options.fTyp is not None : limit -= os.path.getsize(options.fTyp)
+    volumes = partition(imglist, limit, options.sVolumeGrouping, options.iVolumeSize*1048576)
+    names = ['gmapsupp-%02d.img' % (i+1) for i in range(len(volumes))]
+    dirs = [tempfile.mkdtemp(prefix='gmapsupp-', dir=wd) for v in volumes]
+    cmds = []
+    for i in range(len(volumes)) :
+        files = ''.join([' %s' % (item.path) for item in volumes[i].items])
+        cmds.append('java -Xmx%s -jar %s --gmapsupp --output-dir=%s --family-id=%s %s %s' % (mki.text(MkgmapInfo.I_RAM), mkgmap, dirs[i], options.sFamId, files, args))
+    print('Assembling %d volumes of at most %d MB.' % (len(volumes), options.iVolumeSize))
+    rets = runParallel(cmds, threads)
+    for i in range(len(volumes)) :
+        if rets[i] == 0 and os.path.exists(os.path.join(dirs[i], 'gmapsupp.img')) :
+            shutil.move(os.path.join(dirs[i], 'gmapsupp.img'), names[i])
+            print('%s: %d tiles, %.1f MB' % (names[i], len(volumes[i].items), os.path.getsize(names[i]) / 1048576.0))
+        else :
+            print('Error assembling %s!' % (names[i]))
+        shutil.rmtree(dirs[i], True)
+    # The partition is an estimate, check the real sizes
+    failed = checkVolumes(names, options.iVolumeSize*1048576)
+    writeManifest(volumeManifest, volumes, names, dict([(m.text(MapInfo.I_MAP_NUMBER), m.mapID) for m in mapinfolist]), failed)
+    print('Volumes are listed in %s.' % (volumeManifest))
+    if len(failed) > 0 :
+        print('Error: %d of %d volumes failed: %s' % (len(failed), len(volumes), ', '.join([names[i] for i in sorted(failed)])))
+
+# Keep the data directory within the cache budget
+if not mki.empty(MkgmapInfo.I_CACHE_BUDGET) :
+    gc([m.mapID for m in mapinfolist])
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Coordinator and workers on one machine, with runBuild() replaced by a
+# stub writing dummy tiles. Run from the main directory:
+#   python -m unittest discover tests
+
+from __future__ import with_statement
+import os
+import sys
+import stat
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import libDistributed
+from libDistributed import Coordinator, Worker, TileStore, checkResult
+from libBuild import BuildJob
+
+
+class DistributedTest(unittest.TestCase) :
+
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.store = TileStore(os.path.join(self.dir, 'store'))
+        self.runBuild = libDistributed.runBuild
+        self.builds = []
+        self.lock = threading.Lock()
+        self.kill = None	# Name of a job whose first worker dies while building it
+        libDistributed.runBuild = self.stubBuild
+
+    def tearDown(self) :
+        libDistributed.runBuild = self.runBuild
+        shutil.rmtree(self.dir, True)
+
+    def stubBuild(self, job, wdir, logfile, splitter, mkgmap, ram, tmpdir=None, phase=None, prefix='') :
+        worker = self.workers[threading.current_thread()]
+        with self.lock :
+            self.builds.append((job.name, worker))
+            dies = job.name == self.kill and len([b for b in self.builds if b[0] == job.name]) == 1
+        if dies :
+            # As if the worker process was killed: the coordinator sees the
+            # connection closed, the result is never sent.
+            worker.sock.shutdown(socket.SHUT_RDWR)
+        nr = int(job.mapid)
+        for i in (1, 2) :
+            with open(os.path.join(wdir, '%08d.img' % (nr + i)), 'wb') as f :
+                f.write('%s %d' % (job.name, i))
+        return {'ok' : True, 'tiles' : 2, 'splitter-seconds' : 0.1, 'mkgmap-seconds' : 0.1}
+
+    def startWorkers(self, coordinator, n) :
+        self.workers = {}
+        for i in range(n) :
+            w = Worker('127.0.0.1:%d' % (coordinator.port), self.store, 'splitter.jar', 'mkgmap.jar', '100m', self.dir)
+            t = threading.Thread(target=self.runWorker, args=(w,))
+            t.setDaemon(True)
+            self.workers[t] = w
+        for t in self.workers :
+            t.start()
+
+    def runWorker(self, w) :
+        try :
+            w.run()
+        except socket.error :
+            # Connection shut down by the test
+            None
+
+    def build(self, coordinator, names) :
+        results = {}
+        def run(name, nr) :
+            results[name] = coordinator.run(BuildJob(name, '%04d0000' % (nr), name + '.osm.pbf'))
+        threads = [threading.Thread(target=run, args=(names[i], i+1)) for i in range(len(names))]
+        for t in threads :
+            t.setDaemon(True)
+            t.start()
+        for t in threads :
+            t.join(30)
+            self.assertFalse(t.isAlive(), 'Build did not finish')
+        return results
+
+    def testBuild(self) :
+        coordinator = Coordinator(0)
+        self.startWorkers(coordinator, 2)
+        results = self.build(coordinator, ['a', 'b', 'c'])
+        for name in ('a', 'b', 'c') :
+            self.assertTrue(results[name]['ok'])
+            self.assertEqual(len(results[name]['tiles-stored']), 2)
+        filename = os.path.join(self.dir, 'tile.img')
+        self.store.get(results['b']['tiles-stored']['00020001.img'], filename)
+        with open(filename, 'rb') as f :
+            self.assertEqual(f.read(), 'b 1')
+
+    def testWorkerLost(self) :
+        self.kill = 'a'
+        coordinator = Coordinator(0)
+        self.startWorkers(coordinator, 2)
+        results = self.build(coordinator, ['a'])
+        self.assertTrue(results['a']['ok'])
+        # Built by both workers: re-queued after the first one was lost
+        self.assertEqual([b[0] for b in self.builds], ['a', 'a'])
+        self.assertNotEqual(self.builds[0][1], self.builds[1][1])
+
+    def testStoreMode(self) :
+        filename = os.path.join(self.dir, '00010001.img')
+        with open(filename, 'wb') as f :
+            f.write('tile')
+        os.chmod(filename, 0o644)
+        digest = self.store.put(filename)
+        self.assertEqual(stat.S_IMODE(os.stat(self.store.path(digest)).st_mode), 0o644)
+        self.store.get(digest, os.path.join(self.dir, 'copy.img'))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dir, 'copy.img')).st_mode), 0o644)
+
+    def testCheckResult(self) :
+        digest = 'd41d8cd98f00b204e9800998ecf8427e'
+        good = {'ok' : True, 'tiles-stored' : {'00010001.img' : digest}}
+        self.assertEqual(checkResult(good), good)
+        self.assertEqual(checkResult({'ok' : False}), {'ok' : False})
+        for bad in (None, [], {}, {'ok' : 'yes'}, {'ok' : True},
+                {'ok' : True, 'tiles-stored' : {'../../00010001.img' : digest}},
+                {'ok' : True, 'tiles-stored' : {'00010001.img' : '../' + digest[3:]}},
+                {'ok' : True, 'tiles-stored' : {'00010001.img' : 5}}) :
+            self.assertFalse(checkResult(bad)['ok'], bad)
+        self.assertRaises(ValueError, self.store.path, '../etc/passwd')
+
+
+if __name__ == '__main__' :
+    unittest.main()
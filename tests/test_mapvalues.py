@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Regression tests for MapValues (the four check values after the map ID
+# in the TRE header). Run from the main directory:
+#   python -m unittest discover tests
+# To also compare against tiles compiled by mkgmap, point PYMKGMAP_TILES
+# to a directory containing them (e.g. osmData/<map>). Header samples of
+# such tiles are kept in fixtures/tre-headers.txt, to add some:
+#   python tests/test_mapvalues.py --extract osmData/<map> >> tests/fixtures/tre-headers.txt
+
+from __future__ import with_statement
+import os
+import sys
+import glob
+import mmap
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libGarminImg import GarminImg, MapValues
+
+# (map ID, TRE header length, values) as calculated by the original
+# Python port of mkgmap's MapValues.java
+known = [
+    (63240001, 188, (0xd0acfca7, 0xe917ff6a, 0xe96bfca6, 0xe96bfca6)),
+    (63240001, 309, (0xd0acfca7, 0xe990ff6a, 0xe96bfca6, 0xe96bfca6)),
+    (63240002, 188, (0xad7ac954, 0xb6e4cc17, 0xb638c953, 0xb638c953)),
+    (63240002, 309, (0xad7ac954, 0xb66dcc17, 0xb638c953, 0xb638c953)),
+    (10010001, 188, (0x8a1775e7, 0xdd32757e, 0xdd8675e6, 0xdd8675e6)),
+    (10010001, 309, (0x8a1775e7, 0xddbb757e, 0xdd8675e6, 0xdd8675e6)),
+    (20001, 188, (0xd7ba56a9, 0x994556a8, 0x999956a8, 0x999956a8)),
+    (20001, 309, (0xd7ba56a9, 0x99ce56a8, 0x999956a8, 0x999956a8)),
+    (99999999, 188, (0x1f21fb23, 0x3feef017, 0x3f32fb22, 0x3f32fb22)),
+    (99999999, 309, (0x1f21fb23, 0x3f67f017, 0x3f32fb22, 0x3f32fb22)),
+]
+
+samplesFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'tre-headers.txt')
+
+def readSamples(filename) :
+    """(map ID, TRE header length, values) from the samples file."""
+    samples = []
+    with open(filename) as f :
+        for line in f :
+            fields = line.split('#', 1)[0].split()
+            if len(fields) == 0 :
+                continue
+            samples.append((int(fields[0]), int(fields[1]), tuple([int(v, 16) for v in fields[2:6]])))
+    return samples
+
+def treValues(filename) :
+    """(map ID, TRE header length, values) of a compiled tile."""
+    gi = GarminImg(filename)
+    if not gi.readInfo() :
+        return None
+    with open(filename, 'rb') as f :
+        map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pos = gi.trePosition(map)
+        values = struct.unpack('<4I', map[pos+GarminImg.offsetMapValues : pos+GarminImg.offsetMapValues+16])
+        map.close()
+    return (gi.mapId, gi.headerLength, values)
+
+def calculated(mapId, headerLength) :
+    mv = MapValues(mapId, headerLength)
+    mv.calculate()
+    return tuple([mv.value(i) for i in range(4)])
+
+
+class MapValuesTest(unittest.TestCase) :
+
+    def testKnownValues(self) :
+        for (mapId, length, values) in known :
+            self.assertEqual(calculated(mapId, length), values)
+            self.assertEqual(MapValues.batch([mapId], length)[0], values)
+
+    def testBatchEqualsCalculate(self) :
+        ids = range(0, 100000000, 6661) + range(63240000, 63241000)
+        for length in (188, 309, 0xffff) :
+            self.assertEqual(MapValues.batch(ids, length), [calculated(i, length) for i in ids])
+
+    def testHeaderLengthPerId(self) :
+        ids = [m for (m, l, v) in known]
+        lengths = [l for (m, l, v) in known]
+        self.assertEqual(MapValues.batch(ids, lengths), [v for (m, l, v) in known])
+
+    def testCompiledTiles(self) :
+        dir = os.environ.get('PYMKGMAP_TILES')
+        if dir is None :
+            self.skipTest('PYMKGMAP_TILES not set')
+        files = glob.glob(os.path.join(dir, '*.img'))
+        self.assertTrue(len(files) > 0, 'No tiles in %s' % (dir))
+        for filename in files :
+            sample = treValues(filename)
+            self.assertTrue(sample is not None, filename)
+            (mapId, length, values) = sample
+            self.assertEqual(MapValues.batch([mapId], length)[0], values, filename)
+
+    def testSamples(self) :
+        # Values read from tiles compiled by mkgmap, not from this code
+        samples = readSamples(samplesFile)
+        if len(samples) == 0 :
+            self.skipTest('No samples in %s' % (samplesFile))
+        for (mapId, length, values) in samples :
+            self.assertEqual(calculated(mapId, length), values, mapId)
+            self.assertEqual(MapValues.batch([mapId], length)[0], values, mapId)
+
+
+if __name__ == '__main__' :
+    if len(sys.argv) > 2 and sys.argv[1] == '--extract' :
+        # One line per tile for fixtures/tre-headers.txt
+        for filename in sorted(glob.glob(os.path.join(sys.argv[2], '*.img'))) :
+            sample = treValues(filename)
+            if sample is None :
+                sys.stderr.write('Cannot read %s\n' % (filename))
+                continue
+            (mapId, length, values) = sample
+            print('%d %d %s\t# %s' % (mapId, length, ' '.join(['%08x' % (v) for v in values]), os.path.basename(filename)))
+    else :
+        unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Tests for GarminImg.verify() and verifyImgs() with small synthetic
+# tiles. Run from the main directory:
+#   python -m unittest discover tests
+
+from __future__ import with_statement
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libGarminImg import GarminImg, MapValues, verifyImgs
+
+blockSize = 512
+
+def makeImg(filename, mapId, headerLength=188, values=None, rgnSize=0x300, length=None) :
+    """Writes a tile with a TRE subfile in block 8 and an RGN subfile
+    starting at block 9 and returns its content. values: MapValues to
+    write instead of the correct ones. length: Truncate the file."""
+
+    rgnBlocks = (rgnSize + blockSize - 1) // blockSize
+    d = bytearray(9*blockSize + rgnSize)
+    d[0x10:0x17] = 'DSKIMG\x00'
+    d[0x41:0x48] = 'GARMIN\x00'
+    d[0x61] = 9; d[0x62] = 0
+    name = '%08d' % (mapId)
+
+    def entry(pos, type, size, blocks, part=0) :
+        d[pos] = 1
+        d[pos+1:pos+9] = name
+        d[pos+9:pos+12] = type
+        d[pos+12:pos+16] = struct.pack('<I', size if part == 0 else 0)
+        d[pos+16:pos+18] = struct.pack('<H', part)
+        for i in range(len(blocks)) :
+            d[pos+32+2*i:pos+34+2*i] = struct.pack('<H', blocks[i])
+        if len(blocks) < 240 :
+            d[pos+32+2*len(blocks):pos+34+2*len(blocks)] = '\xff\xff'
+
+    entry(0x600, 'TRE', 0x200, [8])
+    # RGN in parts of at most 240 blocks
+    blocks = range(9, 9 + rgnBlocks)
+    pos = 0x800
+    for part in range(0, max(1, (len(blocks) + 239) // 240)) :
+        entry(pos, 'RGN', rgnSize, blocks[240*part : 240*(part+1)], part)
+        pos += 0x200
+
+    t = 8*blockSize
+    d[t:t+2] = struct.pack('<H', headerLength)
+    d[t+2:t+12] = 'GARMIN TRE'
+    d[t+GarminImg.offsetMapID:t+GarminImg.offsetMapID+4] = struct.pack('<I', mapId)
+    if values is None :
+        values = MapValues.batch([mapId], headerLength)[0]
+    d[t+GarminImg.offsetMapValues:t+GarminImg.offsetMapValues+16] = struct.pack('<4I', *values)
+    if length is not None :
+        d = d[:length]
+    with open(filename, 'wb') as f :
+        f.write(str(d))
+    return str(d)
+
+
+class VerifyTest(unittest.TestCase) :
+
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir, True)
+
+    def path(self, name) :
+        return os.path.join(self.dir, name)
+
+    def testGood(self) :
+        makeImg(self.path('00010001.img'), 10001)
+        self.assertEqual(GarminImg(self.path('00010001.img')).verify(), [])
+
+    def testLastBlockShort(self) :
+        # The file ends within the last block of RGN
+        makeImg(self.path('00010001.img'), 10001, rgnSize=0x280)
+        self.assertEqual(os.path.getsize(self.path('00010001.img')) % blockSize, 0x80)
+        self.assertEqual(GarminImg(self.path('00010001.img')).verify(), [])
+
+    def testFullFATEntry(self) :
+        # Last part of RGN with exactly 240 blocks, no 0xffff
+        makeImg(self.path('00010001.img'), 10001, rgnSize=480*blockSize)
+        self.assertEqual(GarminImg(self.path('00010001.img')).verify(), [])
+
+    def testTruncated(self) :
+        makeImg(self.path('00010001.img'), 10001, length=9*blockSize + 0x100)
+        problems = GarminImg(self.path('00010001.img')).verify()
+        self.assertTrue(len([p for p in problems if 'exceeds file size' in p]) > 0, problems)
+
+    def testBadMapValues(self) :
+        makeImg(self.path('00010001.img'), 10001, values=(1, 2, 3, 4))
+        problems = GarminImg(self.path('00010001.img')).verify()
+        self.assertEqual(problems, ['MapValues do not match map ID 10001'])
+
+    def testFATEndsAtEndOfFile(self) :
+        makeImg(self.path('00010001.img'), 10001, length=0x800)
+        self.assertEqual(GarminImg(self.path('00010001.img')).verify(), ['FAT not terminated'])
+
+    def testVerifyImgs(self) :
+        makeImg(self.path('00010001.img'), 10001)
+        makeImg(self.path('00010002.img'), 10002, length=0x800)
+        makeImg(self.path('00010003.img'), 10003, values=(1, 2, 3, 4))
+        with open(self.path('00010004.img'), 'wb') as f :
+            None
+        files = [self.path('0001000%d.img' % (i)) for i in range(1, 5)]
+        suspect = verifyImgs(files, 2)
+        self.assertEqual(sorted(suspect.keys()), files[1:])
+
+
+if __name__ == '__main__' :
+    unittest.main()
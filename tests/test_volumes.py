@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Tests for the size estimates of gmapsupp volumes. Run from the main
+# directory:
+#   python -m unittest discover tests
+
+from __future__ import with_statement
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libGarminImg import Subfile
+from libVolumes import blockSizeFor, itemSize, partition, checkVolumes, writeManifest
+
+MB = 1048576
+
+class FakeTile :
+    def __init__(self, sizes) :
+        self.subfiles = [Subfile('00010001', 'TRE', 0, s) for s in sizes]
+        self.size = sum(sizes)
+        self.bounds = (0, 0, 0, 0)
+
+class FakeItem :
+    def __init__(self, id, sizes, path='tile.img') :
+        self.id = id
+        self.path = path
+        self.tile = FakeTile(sizes)
+
+
+class VolumesTest(unittest.TestCase) :
+
+    def testBlockSize(self) :
+        self.assertEqual(blockSizeFor(1*MB), 512)
+        self.assertEqual(blockSizeFor(0xffff*512), 512)
+        self.assertEqual(blockSizeFor(0xffff*512 + 1), 1024)
+        self.assertEqual(blockSizeFor(4000*MB), 65536)
+        self.assertEqual(blockSizeFor(0xffff*65536 + 1), 131072)
+
+    def testItemSize(self) :
+        # Every subfile takes whole blocks plus one FAT entry per 240 blocks
+        item = FakeItem(1, [100, 70000])
+        self.assertEqual(itemSize(item, 512), 512 + 0x200 + 137*512 + 0x200)
+        self.assertEqual(itemSize(item, 65536), 65536 + 0x200 + 2*65536 + 0x200)
+        self.assertEqual(itemSize(FakeItem(1, [241*512]), 512), 241*512 + 2*0x200)
+
+    def testPartitionNearFAT32(self) :
+        # Tiles of 30 MB with two small subfiles each: 133 of them fit
+        # into 3999 MB by their file sizes, but not with the small
+        # subfiles rounded up to the 64 KB blocks of a 4000 MB volume.
+        items = [FakeItem(1, [30*MB, 100, 100]) for i in range(133)]
+        limit = 3999*MB
+        self.assertTrue(sum([i.tile.size for i in items]) <= limit)
+        volumes = partition(items, limit, volumeSize=4000*MB)
+        self.assertEqual(volumes[0].blockSize, 65536)
+        self.assertEqual(len(volumes), 2)
+        for v in volumes :
+            self.assertTrue(v.size <= limit)
+        self.assertEqual(sum([len(v.items) for v in volumes]), 133)
+
+    def testManifest(self) :
+        dir = tempfile.mkdtemp()
+        try :
+            names = [os.path.join(dir, 'gmapsupp-%02d.img' % (i)) for i in (1, 2, 3)]
+            for (name, size) in zip(names[:2], (1000, 3000)) :
+                with open(name, 'wb') as f :
+                    f.write('\0' * size)
+            failed = checkVolumes(names, 2000)
+            self.assertEqual(failed, set([1, 2]))
+            volumes = partition([FakeItem(i, [100]) for i in (1, 2, 3)], 1024)
+            manifest = os.path.join(dir, 'manifest.xml')
+            writeManifest(manifest, volumes, names, {}, failed)
+            status = [v.get('status') for v in etree.parse(manifest).getroot().findall('volume')]
+            self.assertEqual(status, ['ok', 'failed', 'failed'])
+        finally :
+            shutil.rmtree(dir, True)
+
+
+if __name__ == '__main__' :
+    unittest.main()